@@ -0,0 +1,50 @@
+"""Load time of a large program: parsing its source vs decoding its .fattc.
+
+Run it with the same python used for the untranslated interpreter:
+
+    python bench/cache_bench.py [ITEMS]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fatt_cache import decode, encode, source_digest
+from fatt_parser import parse
+
+
+def program_code(n):
+    item = '{@x%d is (%d + 1), [x%d, "s%d", 1.5] : x%d}'
+    return "{" + ", ".join([item % (i, i, i, i, i) for i in range(n)]) + "}"
+
+
+def main(argv):
+    items = int(argv[1]) if len(argv) > 1 else 20000
+    code = program_code(items)
+    digest = source_digest(code)
+
+    start = time.time()
+    expr = parse(code)
+    parse_time = time.time() - start
+
+    data = encode(expr, digest)
+
+    start = time.time()
+    cached = decode(data, digest)
+    decode_time = time.time() - start
+
+    if cached.to_str() != expr.to_str():
+        print("decoded program differs from the parsed one")
+        return 1
+
+    print("source %8d bytes  parse  %8.3fs" % (len(code), parse_time))
+    print("fattc  %8d bytes  decode %8.3fs" % (len(data), decode_time))
+    print("speedup %.1fx" % (parse_time / decode_time))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,78 @@
+"""Parser regression benchmark: large array, map and block literals.
+
+Parse time must grow linearly with the number of items, run it with the
+same python used for the untranslated interpreter:
+
+    python bench/parse_bench.py [ITEMS]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fatt_parser import parse
+
+# per item cost may grow this much from the smallest to the largest size
+# before it's reported as non linear, quadratic growth is 16x over 4 sizes
+MAX_COST_GROWTH = 3.0
+
+
+def array_code(n):
+    return "[" + ", ".join([str(i) for i in range(n)]) + "]"
+
+
+def map_code(n):
+    return "#{" + ", ".join(['"k%d": %d' % (i, i) for i in range(n)]) + "}"
+
+
+def block_code(n):
+    return "{" + ", ".join([str(i) for i in range(n)]) + "}"
+
+
+def send_code(n):
+    return "0" + " + 1" * n
+
+
+def time_parse(code):
+    start = time.time()
+    parse(code)
+    return time.time() - start
+
+
+def main(argv):
+    items = int(argv[1]) if len(argv) > 1 else 100000
+    sizes = [items // 8, items // 4, items // 2, items]
+    ok = True
+
+    for name, make_code in [
+        ("array", array_code),
+        ("map", map_code),
+        ("block", block_code),
+        ("send", send_code),
+    ]:
+        costs = []
+
+        for size in sizes:
+            elapsed = time_parse(make_code(size))
+            costs.append(elapsed / size)
+            print(
+                "%-6s %8d items %8.3fs %8.2fus/item"
+                % (name, size, elapsed, costs[-1] * 1e6)
+            )
+
+        growth = costs[-1] / costs[0]
+
+        if growth > MAX_COST_GROWTH:
+            print(
+                "%-6s per item cost grew %.1fx, parsing is not linear" % (name, growth)
+            )
+            ok = False
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
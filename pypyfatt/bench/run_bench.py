@@ -0,0 +1,279 @@
+"""Runs the fatt benchmark programs on one or more interpreters and writes
+the results as JSON, to compare them between commits.
+
+Each interpreter is given as NAME=COMMAND, the program file is appended to
+COMMAND after --stats:
+
+    python bench/run_bench.py --out fatt-c.json fatt-c=./fatt-c
+    python bench/run_bench.py --quick untranslated="pypy fatt.py"
+    python bench/run_bench.py vm="./fatt-c-jit --vm" jit=./fatt-c-jit
+
+Every run is a fresh process, wall time, sends (as counted by --stats) and
+peak RSS are taken from it and its output is checked against the value the
+program must return.
+"""
+
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+# the default CEK engine keeps its continuation on the heap, but --vm still
+# recurses on the host stack for each send, so loops are balanced trees of
+# handler calls: every engine nests as deep as their levels, not their length
+LOOP = """
+@(0 loop 0) replies @((it > 0) loopr it),
+@(0 loopr 0) replies @(((it - 1) loop 0) + ((it - 1) loop 0)),
+@(() loopr 0) replies @%s,
+%d loop 0
+"""
+
+
+def fib(n):
+    a, b = 0, 1
+
+    for _ in range(n):
+        a, b = b, a + b
+
+    return a
+
+
+def fib_code(n):
+    return """
+@(0 fib 0) replies @((it >= 2) fibr it),
+@(0 fibr 0) replies @(((it - 1) fib 0) + ((it - 2) fib 0)),
+@(() fibr 0) replies @that,
+%d fib 0
+""" % n
+
+
+def loop_code(n):
+    return LOOP % ("1", n)
+
+
+def blocks_code(n):
+    leaf = "1"
+
+    for i in range(32):
+        leaf = "{%d, %s}" % (i, leaf)
+
+    return LOOP % (leaf, n)
+
+
+def arrays_code(n):
+    items = ["(%d + 1)" % i for i in range(64)]
+    kvs = ['"k%d": (%d + 1)' % (i, i) for i in range(64)]
+    leaf = "{[%s], #{%s}, 1}" % (", ".join(items), ", ".join(kvs))
+    return LOOP % (leaf, n)
+
+
+def append_code(n):
+    # the array goes down the tree and back, so it's appended to 2 ** n times
+    return """
+@([] grow 0) replies @((that > 0) growr [it, that]),
+@(0 growr 0) replies @(((that . 0) grow (it - 1)) grow (it - 1)),
+@(() growr 0) replies @((that . 0) append 1),
+([] grow %d) size ()
+""" % n
+
+
+def concat_code(n):
+    return """
+@(0 cat 0) replies @((it > 0) catr it),
+@(0 catr 0) replies @(((it - 1) cat 0) + ((it - 1) cat 0)),
+@(() catr 0) replies @"ab",
+%d cat 0
+""" % n
+
+
+def ternary_code(n):
+    leaf = "(1 ? (@ 1) : (@ 0))"
+
+    for i in range(24):
+        cond = "()" if i % 2 == 0 else "(%d > %d)" % (i, i + 1)
+        leaf = "(%s ? (@ 0) : (@ %s))" % (cond, leaf)
+
+    return LOOP % (leaf, n)
+
+
+# name, program for size n, its expected output, n for --quick and full runs
+BENCHMARKS = [
+    ("startup", lambda n: str(n), str, 0, 0),
+    ("fib", fib_code, lambda n: str(fib(n)), 14, 24),
+    ("loop", loop_code, lambda n: str(2**n), 12, 20),
+    ("blocks", blocks_code, lambda n: str(2**n), 8, 16),
+    ("arrays", arrays_code, lambda n: str(2**n), 6, 14),
+    ("append", append_code, lambda n: str(2**n), 10, 18),
+    ("concat", concat_code, lambda n: '"' + "ab" * 2**n + '"', 10, 18),
+    ("ternary", ternary_code, lambda n: str(2**n), 8, 16),
+]
+
+
+def git_info():
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here)
+        status = subprocess.check_output(["git", "status", "--porcelain"], cwd=here)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit.decode().strip(), len(status.strip()) > 0
+
+
+def run_once(command, path):
+    """Runs command on the program at path, returns its output, the sends it
+    made, wall time and peak RSS in KiB."""
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        start = time.time()
+        proc = subprocess.Popen(command + ["--stats", path], stdout=out, stderr=err)
+        # wait4 instead of wait to get the rusage of this child alone
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.time() - start
+        proc.returncode = status
+
+        out.seek(0)
+        err.seek(0)
+        output = out.read().decode("utf-8", "replace").strip()
+        sends = None
+
+        for line in err.read().decode("utf-8", "replace").splitlines():
+            if line.startswith("sends: "):
+                sends = int(line[len("sends: ") :])
+
+    return output, sends, wall, usage.ru_maxrss
+
+
+def run_bench(engine, command, name, code, expected, n, repeat, tmp_dir):
+    path = os.path.join(tmp_dir, "%s-%d.fatt" % (name, n))
+
+    with open(path, "w") as f:
+        f.write(code)
+
+    walls = []
+    max_rss = 0
+    sends = None
+    ok = True
+    output = ""
+
+    for _ in range(repeat):
+        output, sends, wall, rss = run_once(command, path)
+        walls.append(wall)
+        max_rss = max(max_rss, rss)
+        # output may end with whatever the engine printed before the result
+        lines = output.splitlines()
+        ok = ok and len(lines) > 0 and lines[-1] == expected
+
+    walls.sort()
+    result = {
+        "engine": engine,
+        "bench": name,
+        "n": n,
+        "ok": ok,
+        "wall": walls,
+        "wall_min": walls[0],
+        "wall_median": walls[len(walls) // 2],
+        "sends": sends,
+        "sends_per_sec": sends / walls[0] if sends and walls[0] > 0 else None,
+        "max_rss_kb": max_rss,
+    }
+
+    if not ok:
+        result["output"] = output[-500:]
+
+    return result
+
+
+def parse_engine(spec):
+    name, sep, command = spec.partition("=")
+
+    if not sep or not name or not command:
+        raise argparse.ArgumentTypeError("expected NAME=COMMAND, got %r" % spec)
+
+    return name, shlex.split(command)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "engines", nargs="+", type=parse_engine, metavar="NAME=COMMAND"
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="small sizes, for untranslated runs"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", default="", help="comma separated benchmark names")
+    parser.add_argument(
+        "--out", help="write the JSON results here instead of stdout"
+    )
+    args = parser.parse_args(argv[1:])
+
+    only = [name for name in args.only.split(",") if name]
+    commit, dirty = git_info()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.datetime.utcnow().isoformat() + "Z",
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "repeat": args.repeat,
+        "engines": dict((name, command) for name, command in args.engines),
+        "results": [],
+    }
+    tmp_dir = tempfile.mkdtemp(prefix="fatt-bench-")
+    ok = True
+
+    for engine, command in args.engines:
+        for name, make_code, make_expected, quick_n, full_n in BENCHMARKS:
+            if only and name not in only:
+                continue
+
+            n = quick_n if args.quick else full_n
+            code = make_code(n)
+            expected = make_expected(n)
+            result = run_bench(
+                engine, command, name, code, expected, n, args.repeat, tmp_dir
+            )
+            sends_per_sec = result["sends_per_sec"]
+            report["results"].append(result)
+            ok = ok and result["ok"]
+
+            print(
+                "%-12s %-8s n=%-3d %8.3fs %12s sends/s %8d KiB %s"
+                % (
+                    engine,
+                    name,
+                    n,
+                    result["wall_min"],
+                    "%.0f" % sends_per_sec if sends_per_sec else "-",
+                    result["max_rss_kb"],
+                    "ok" if result["ok"] else "WRONG OUTPUT",
+                ),
+                file=sys.stderr,
+            )
+
+    for name in os.listdir(tmp_dir):
+        os.remove(os.path.join(tmp_dir, name))
+
+    os.rmdir(tmp_dir)
+    data = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,249 +1,246 @@
 from __future__ import print_function
+import os
 import sys
 from fatt_types import *
 from fatt_parser import parse
+from fatt_cache import cache_path_for, parse_cached, read_file
+from fatt_stream import open_statements
+from fatt_prelude import new_program_frame
+from fatt_opt import fold_program
+from fatt_vm import use_vm
+from fatt_cek import use_cek
+from fatt_profile import profiler
+from fatt_sched import Scheduler
 from rply import LexingError, ParsingError
 
 
-def name_lookup(s, _m, e):
-    v = e.find(s.name)
-    if v is None:
-        fail("Name " + s.name + " not found")
-    else:
-        return v
+class Settings(object):
+    def __init__(self):
+        self.phases = False
+        # --tasks spawns the batch's programs here instead of running them
+        self.scheduler = None
+        self.quantum = 1000
+        self.send_limit = -1
+        self.time_limit = -1.0
 
 
-def later_eval(s, m, e):
-    return s.lval
+settings = Settings()
 
 
-def block_eval(s, m, e):
-    r = NIL
-    for item in s.items:
-        r = e.eval(item)
+def prepare_expr(expr, e):
+    if settings.phases:
+        expr = fold_program(expr, e)
 
-    return r
+    return expr
 
 
-def array_eval(s, m, e):
-    r = []
-    for item in s.items:
-        r.append(e.eval(item))
+def eval_expr(expr, e):
+    return engine_ref.engine.eval_program(prepare_expr(expr, e), e)
 
-    return Array(r)
 
+def error_message(err):
+    if isinstance(err, Error):
+        return "Runtime Error: " + err.msg
+    elif isinstance(err, LexingError):
+        # rply raises it without a message
+        return "Lexing Error | " + format_pos(err.source_pos)
+    elif isinstance(err, ParsingError):
+        return "Parsing Error: " + err.message + " | " + format_pos(err.source_pos)
+    elif isinstance(err, RuntimeError):
+        # the paths that still recurse on the host stack, like natives
+        return "Runtime Error: stack overflow"
+    else:
+        return "Error: " + str(err)
 
-def map_eval(s, m, e):
-    r = {}
-    for k, v in s.kv.iteritems():
-        r[k] = e.eval(v)
 
-    return Map(r)
+def report_error(err):
+    print(error_message(err))
 
 
-def pair_eval(s, m, e):
-    return Pair(e.eval(s.a), e.eval(s.b))
+def run_code(e, code, cache_path=None):
+    try:
+        if cache_path is None:
+            expr = parse(code)
+        else:
+            expr = parse_cached(code, cache_path)
 
+        print(eval_expr(expr, e).to_str())
+    except Exception as err:
+        report_error(err)
 
-def msg_eval(s, _m, e):
-    return Msg(s.verb, e.eval(s.obj))
 
+def run_file(e, path):
+    """Runs the file at path one top level statement at a time, in the same
+    frame like the items of a block, and prints the value of the last one."""
+    reader = open_statements(path)
 
-def send_eval(s, m, e):
-    subj = e.eval(s.subj)
-    msg = e.eval(s.msg)
+    if reader is None:
+        print("Error: can't open", path)
+        return 1
 
-    return (
-        e.down().set_up_limit().bind("it", subj).bind("that", msg.obj).send(subj, msg)
-    )
+    try:
+        r = NIL
+        code = reader.next()
 
+        while code is not None:
+            expr = parse(code, reader.stmt_lineno, reader.stmt_colno)
+            r = eval_expr(expr, e)
+            code = reader.next()
 
-def nil_ternary(s, m, e):
-    if isinstance(m.obj, Pair):
-        return e.eval(m.obj.b)
-    else:
-        val_type_expected(TYPE_PAIR, m.obj)
+        print(r.to_str())
+    except Exception as err:
+        report_error(err)
+    finally:
+        reader.close()
 
+    return 0
 
-def true_ternary(s, m, e):
-    if isinstance(m.obj, Pair):
-        return e.eval(m.obj.a)
-    else:
-        val_type_expected(TYPE_PAIR, m.obj)
 
+class TaskReporter(object):
+    """Prints each task's result as it finishes, prefixed by its number."""
 
-def nil_and(s, m, e):
-    return s
+    def done(self, task, value):
+        print("[" + str(task.index) + "]", value.to_str())
 
+    def failed(self, task, err):
+        print("[" + str(task.index) + "]", error_message(err))
 
-def true_and(s, m, e):
-    return e.eval(m.obj)
 
+def spawn_task(scheduler, code):
+    e = new_program_frame()
 
-def nil_or(s, m, e):
-    return e.eval(m.obj)
+    try:
+        scheduler.spawn(prepare_expr(parse(code), e), e)
+    except Exception as err:
+        # it gets a number like the others, so the output lines up
+        print("[" + str(scheduler.spawned) + "]", error_message(err))
+        scheduler.spawned += 1
 
 
-def true_or(s, m, e):
-    return s
+def run_batch_item(code, sep):
+    if sep == "\n" and (len(code) == 0 or code[0] == "#"):
+        return
 
+    if settings.scheduler is not None:
+        spawn_task(settings.scheduler, code)
+    else:
+        run_code(new_program_frame(), code)
 
-def entry_point(argv):
-    f = Frame()
 
-    nil_proto = Frame()
-    nil_proto.bind("eval", Handler(lambda s, m, e: s))
+def run_batch(fd, sep):
+    pending = ""
+
+    while True:
+        chunk = os.read(fd, 65536)
 
-    nil_proto.bind("<", nil_compop(lambda a, b: False))
-    nil_proto.bind("<=", nil_compop(lambda a, b: False))
-    nil_proto.bind(">", nil_compop(lambda a, b: False))
-    nil_proto.bind(">=", nil_compop(lambda a, b: False))
-    nil_proto.bind("=", nil_compop(lambda a, b: b.is_nil()))
-    nil_proto.bind("!=", nil_compop(lambda a, b: not b.is_nil()))
+        if len(chunk) == 0:
+            break
 
-    nil_proto.bind("?", Handler(nil_ternary))
-    nil_proto.bind("and", Handler(nil_and))
-    nil_proto.bind("or", Handler(nil_or))
+        pending += chunk
+        start = 0
+        end = pending.find(sep, start)
 
-    int_proto = Frame()
-    int_proto.bind("eval", Handler(lambda s, m, e: s))
+        while end != -1:
+            assert end >= 0
+            run_batch_item(pending[start:end], sep)
+            start = end + 1
+            end = pending.find(sep, start)
 
-    int_proto.bind("+", int_binop(lambda a, b: a + b))
-    int_proto.bind("-", int_binop(lambda a, b: a - b))
-    int_proto.bind("*", int_binop(lambda a, b: a * b))
+        pending = pending[start:]
 
-    int_proto.bind("<", int_compop(lambda a, b: a < b))
-    int_proto.bind("<=", int_compop(lambda a, b: a <= b))
-    int_proto.bind(">", int_compop(lambda a, b: a > b))
-    int_proto.bind(">=", int_compop(lambda a, b: a >= b))
-    int_proto.bind("=", int_compop(lambda a, b: a == b))
-    int_proto.bind("!=", int_compop(lambda a, b: a != b))
+    if len(pending) > 0:
+        run_batch_item(pending, sep)
 
-    int_proto.bind("?", Handler(true_ternary))
-    int_proto.bind("and", Handler(true_and))
-    int_proto.bind("or", Handler(true_or))
-
-    float_proto = Frame()
-    float_proto.bind("eval", Handler(lambda s, m, e: s))
-
-    float_proto.bind("+", float_binop(lambda a, b: a + b))
-    float_proto.bind("-", float_binop(lambda a, b: a - b))
-    float_proto.bind("*", float_binop(lambda a, b: a * b))
-    float_proto.bind("/", float_binop(lambda a, b: a / b))
-
-    float_proto.bind("<", float_compop(lambda a, b: a < b))
-    float_proto.bind("<=", float_compop(lambda a, b: a <= b))
-    float_proto.bind(">", float_compop(lambda a, b: a > b))
-    float_proto.bind(">=", float_compop(lambda a, b: a >= b))
-    float_proto.bind("=", float_compop(lambda a, b: a == b))
-    float_proto.bind("!=", float_compop(lambda a, b: a != b))
-
-    float_proto.bind("?", Handler(true_ternary))
-    float_proto.bind("and", Handler(true_and))
-    float_proto.bind("or", Handler(true_or))
-
-    str_proto = Frame()
-    str_proto.bind("eval", Handler(lambda s, m, e: s))
-
-    str_proto.bind("+", str_binop(lambda a, b: a + b))
-
-    str_proto.bind("<", str_compop(lambda a, b: a < b))
-    str_proto.bind("<=", str_compop(lambda a, b: a <= b))
-    str_proto.bind(">", str_compop(lambda a, b: a > b))
-    str_proto.bind(">=", str_compop(lambda a, b: a >= b))
-    str_proto.bind("=", str_compop(lambda a, b: a == b))
-    str_proto.bind("!=", str_compop(lambda a, b: a != b))
-
-    str_proto.bind("?", Handler(true_ternary))
-    str_proto.bind("and", Handler(true_and))
-    str_proto.bind("or", Handler(true_or))
-
-    name_proto = Frame()
-    name_proto.bind("eval", Handler(name_lookup))
-
-    name_proto.bind("?", Handler(true_ternary))
-    name_proto.bind("and", Handler(true_and))
-    name_proto.bind("or", Handler(true_or))
-
-    later_proto = Frame()
-    later_proto.bind("eval", Handler(later_eval))
-
-    later_proto.bind("?", Handler(true_ternary))
-    later_proto.bind("and", Handler(true_and))
-    later_proto.bind("or", Handler(true_or))
-
-    block_proto = Frame()
-    block_proto.bind("eval", Handler(block_eval))
-
-    block_proto.bind("?", Handler(true_ternary))
-    block_proto.bind("and", Handler(true_and))
-    block_proto.bind("or", Handler(true_or))
-
-    pair_proto = Frame()
-    pair_proto.bind("eval", Handler(pair_eval))
-
-    pair_proto.bind("?", Handler(true_ternary))
-    pair_proto.bind("and", Handler(true_and))
-    pair_proto.bind("or", Handler(true_or))
-
-    array_proto = Frame()
-    array_proto.bind("eval", Handler(array_eval))
-
-    array_proto.bind("?", Handler(true_ternary))
-    array_proto.bind("and", Handler(true_and))
-    array_proto.bind("or", Handler(true_or))
-
-    map_proto = Frame()
-    map_proto.bind("eval", Handler(map_eval))
-
-    map_proto.bind("?", Handler(true_ternary))
-    map_proto.bind("and", Handler(true_and))
-    map_proto.bind("or", Handler(true_or))
-
-    msg_proto = Frame()
-    msg_proto.bind("eval", Handler(msg_eval))
-
-    msg_proto.bind("?", Handler(true_ternary))
-    msg_proto.bind("and", Handler(true_and))
-    msg_proto.bind("or", Handler(true_or))
-
-    send_proto = Frame()
-    send_proto.bind("eval", Handler(send_eval))
-
-    send_proto.bind("?", Handler(true_ternary))
-    send_proto.bind("and", Handler(true_and))
-    send_proto.bind("or", Handler(true_or))
-
-    f.bind_type(TYPE_NIL, nil_proto)
-    f.bind_type(TYPE_INT, int_proto)
-    f.bind_type(TYPE_FLOAT, float_proto)
-    f.bind_type(TYPE_STR, str_proto)
-    f.bind_type(TYPE_LATER, later_proto)
-    f.bind_type(TYPE_BLOCK, block_proto)
-    f.bind_type(TYPE_PAIR, pair_proto)
-    f.bind_type(TYPE_ARRAY, array_proto)
-    f.bind_type(TYPE_MAP, map_proto)
-    f.bind_type(TYPE_NAME, name_proto)
-    f.bind_type(TYPE_MSG, msg_proto)
-    f.bind_type(TYPE_SEND, send_proto)
-
-    f1 = f.right().down()
-
-    if len(argv) > 1:
-        code = argv[1]
-        try:
-            expr = parse(code).to_type()
-            print(f1.eval(expr).to_str())
-        except Error as err:
-            print("Runtime Error:", err.msg)
-        except LexingError as err:
-            print("Lexing Error:", err.message, "|", format_pos(err.source_pos))
-        except ParsingError as err:
-            print("Parsing Error:", err.message, "|", format_pos(err.source_pos))
-        except Exception as err:
-            print("Error:", str(err))
+
+def entry_point(argv):
+    profile_path = None
+    use_cek()
+
+    while len(argv) > 1:
+        if argv[1] == "--vm":
+            use_vm()
+        elif argv[1] == "--phases":
+            settings.phases = True
+        elif argv[1] == "--stats":
+            dispatch_info.count_sends = True
+        elif argv[1] == "--profile" and len(argv) > 2:
+            profiler.enable()
+            profile_path = argv[2]
+            argv = [argv[0]] + argv[2:]
+        elif argv[1] == "--quantum" and len(argv) > 2:
+            settings.quantum = int(argv[2])
+            argv = [argv[0]] + argv[2:]
+        elif argv[1] == "--max-sends" and len(argv) > 2:
+            settings.send_limit = int(argv[2])
+            argv = [argv[0]] + argv[2:]
+        elif argv[1] == "--max-time" and len(argv) > 2:
+            settings.time_limit = float(argv[2])
+            argv = [argv[0]] + argv[2:]
+        else:
+            break
+
+        argv = [argv[0]] + argv[2:]
+
+    if len(argv) > 1 and argv[1] == "--tasks":
+        settings.scheduler = Scheduler(
+            settings.quantum, settings.send_limit, settings.time_limit
+        )
+        argv = [argv[0], "--batch"] + argv[2:]
+
+    if len(argv) > 1 and (argv[1] == "--batch" or argv[1] == "--batch0"):
+        sep = "\n" if argv[1] == "--batch" else "\x00"
+
+        if len(argv) > 2 and argv[2] != "-":
+            try:
+                fd = os.open(argv[2], os.O_RDONLY, 0)
+            except OSError:
+                print("Error: can't open", argv[2])
+                return 1
+
+            run_batch(fd, sep)
+            os.close(fd)
+        else:
+            run_batch(0, sep)
+
+        if settings.scheduler is not None:
+            settings.scheduler.run(TaskReporter())
+    elif len(argv) > 2 and argv[1] == "--file":
+        code = read_file(argv[2])
+
+        if code is None:
+            print("Error: can't open", argv[2])
+            return 1
+
+        run_code(new_program_frame(), code, cache_path_for(argv[2]))
+    elif len(argv) > 1 and argv[1].endswith(".fatt"):
+        if run_file(new_program_frame(), argv[1]) != 0:
+            return 1
+    elif len(argv) > 1:
+        run_code(new_program_frame(), argv[1])
     else:
         print("usage: fatt '1 + 2'")
+        print("       fatt FILE.fatt        run FILE a statement at a time")
+        print("       fatt --batch [FILE]   one program per line")
+        print("       fatt --batch0 [FILE]  NUL separated programs")
+        print("       fatt --tasks [FILE]   run one program per line concurrently")
+        print("            [--quantum N] [--max-sends N] [--max-time SECONDS] ...")
+        print("       fatt --file FILE      run FILE, caching its AST in FILEc")
+        print("       fatt --vm ...         run on the bytecode VM")
+        print("       fatt --phases ...     fold constants before running")
+        print("       fatt --stats ...      print sends and cache hits to stderr")
+        print("       fatt --profile OUT ...  print per verb send stats to stderr")
+        print("                               and write collapsed stacks to OUT")
+
+    if dispatch_info.count_sends:
+        os.write(2, "sends: %d\n" % dispatch_info.sends)
+        os.write(
+            2,
+            "dispatch cache: %d hits, %d misses\n"
+            % (dispatch_info.hits, dispatch_info.misses),
+        )
+
+    if profile_path is not None:
+        profiler.report(profile_path)
 
     return 0
 
@@ -0,0 +1,327 @@
+from __future__ import print_function
+import os
+from rpython.rlib.rarithmetic import LONG_BIT, intmask, r_uint, r_ulonglong
+from rpython.rlib.rbigint import rbigint
+from rpython.rlib.rsha import RSHA
+from rpython.rlib.rstruct.ieee import float_pack, float_unpack
+from fatt_types import *
+from fatt_parser import parse
+
+# .fattc files hold a parsed program: MAGIC, the sha1 of its source and the
+# AST, each node a tag byte followed by its fields. Counts and lengths are
+# varints, Int is a zigzag varint, a BigInt its decimal string and Float 8 bytes
+# little endian.
+
+MAGIC = "fattc\x01"
+DIGEST_SIZE = 20
+
+TAG_NIL = "n"
+TAG_INT = "i"
+TAG_BIG_INT = "I"
+TAG_FLOAT = "f"
+TAG_STR = "s"
+TAG_NAME = "a"
+TAG_LATER = "l"
+TAG_BLOCK = "b"
+TAG_ARRAY = "r"
+TAG_MAP = "m"
+TAG_PAIR = "p"
+TAG_MSG = "g"
+TAG_SEND = "d"
+
+
+class CacheError(Exception):
+    pass
+
+
+def source_digest(code):
+    return RSHA(code).digest()
+
+
+def cache_path_for(path):
+    if path.endswith(".fatt"):
+        return path + "c"
+    else:
+        return path + ".fattc"
+
+
+class Encoder(object):
+    def __init__(self):
+        self.out = []
+
+    def write_varint(self, n):
+        n = r_uint(n)
+
+        while n >= 0x80:
+            self.out.append(chr(intmask(n & 0x7F) | 0x80))
+            n >>= 7
+
+        self.out.append(chr(intmask(n)))
+
+    def write_int(self, i):
+        # zigzag, so small negative ints stay short too
+        self.write_varint((r_uint(i) << 1) ^ r_uint(i >> (LONG_BIT - 1)))
+
+    def write_u64(self, q):
+        for i in range(8):
+            self.out.append(chr(intmask((q >> (8 * i)) & 0xFF)))
+
+    def write_str(self, s):
+        self.write_varint(len(s))
+        self.out.append(s)
+
+    def write_node(self, node):
+        if isinstance(node, Nil):
+            self.out.append(TAG_NIL)
+        elif isinstance(node, Int):
+            self.out.append(TAG_INT)
+            self.write_int(node.ival)
+        elif isinstance(node, BigInt):
+            self.out.append(TAG_BIG_INT)
+            self.write_str(node.bval.str())
+        elif isinstance(node, Float):
+            self.out.append(TAG_FLOAT)
+            self.write_u64(float_pack(node.fval, 8))
+        elif isinstance(node, Str):
+            self.out.append(TAG_STR)
+            self.write_str(node.flatten())
+        elif isinstance(node, Name):
+            self.out.append(TAG_NAME)
+            self.write_str(node.name)
+        elif isinstance(node, Later):
+            self.out.append(TAG_LATER)
+            self.write_node(node.lval)
+        elif isinstance(node, Block):
+            self.out.append(TAG_BLOCK)
+            self.write_varint(len(node.items))
+
+            for item in node.items:
+                self.write_node(item)
+        elif isinstance(node, Array):
+            self.out.append(TAG_ARRAY)
+            items = node.items()
+            self.write_varint(len(items))
+
+            for item in items:
+                self.write_node(item)
+        elif isinstance(node, Map):
+            self.out.append(TAG_MAP)
+            leaves = node.kv.leaves()
+            self.write_varint(len(leaves))
+
+            for leaf in leaves:
+                self.write_str(leaf.key)
+                self.write_node(leaf.value)
+        elif isinstance(node, Pair):
+            self.out.append(TAG_PAIR)
+            self.write_node(node.a)
+            self.write_node(node.b)
+        elif isinstance(node, Msg):
+            self.out.append(TAG_MSG)
+            self.write_str(node.verb)
+            self.write_node(node.obj)
+        elif isinstance(node, Send):
+            self.out.append(TAG_SEND)
+            self.write_node(node.subj)
+            self.write_node(node.msg)
+        else:
+            raise CacheError()
+
+
+def encode(node, digest):
+    enc = Encoder()
+    enc.out.append(MAGIC)
+    enc.out.append(digest)
+    enc.write_node(node)
+    return "".join(enc.out)
+
+
+class Decoder(object):
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+
+    def read_byte(self):
+        if self.pos >= len(self.data):
+            raise CacheError()
+
+        c = self.data[self.pos]
+        self.pos += 1
+        return c
+
+    def read_varint(self):
+        n = r_uint(0)
+        shift = 0
+
+        while True:
+            b = ord(self.read_byte())
+            n |= r_uint(b & 0x7F) << shift
+
+            if b < 0x80:
+                return n
+
+            shift += 7
+
+            if shift > 63:
+                raise CacheError()
+
+    def read_count(self):
+        n = intmask(self.read_varint())
+
+        if n < 0 or n > len(self.data):
+            raise CacheError()
+
+        return n
+
+    def read_int(self):
+        n = self.read_varint()
+        return intmask(n >> 1) ^ -intmask(n & 1)
+
+    def read_u64(self):
+        q = r_ulonglong(0)
+
+        for i in range(8):
+            q |= r_ulonglong(ord(self.read_byte())) << (8 * i)
+
+        return q
+
+    def read_str(self):
+        n = self.read_count()
+        start = self.pos
+        end = start + n
+
+        if end > len(self.data):
+            raise CacheError()
+
+        assert start >= 0 and end >= 0
+        self.pos = end
+        return self.data[start:end]
+
+    def read_nodes(self):
+        n = self.read_count()
+        return [self.read_node() for _ in range(n)]
+
+    def read_node(self):
+        tag = self.read_byte()
+
+        if tag == TAG_NIL:
+            return NIL
+        elif tag == TAG_INT:
+            return new_int(self.read_int())
+        elif tag == TAG_BIG_INT:
+            return new_big_int(rbigint.fromdecimalstr(self.read_str()))
+        elif tag == TAG_FLOAT:
+            return Float(float_unpack(self.read_u64(), 8))
+        elif tag == TAG_STR:
+            return Str(self.read_str())
+        elif tag == TAG_NAME:
+            return Name(self.read_str())
+        elif tag == TAG_LATER:
+            return Later(self.read_node())
+        elif tag == TAG_BLOCK:
+            return Block([item for item in self.read_nodes()])
+        elif tag == TAG_ARRAY:
+            return new_array(self.read_nodes())
+        elif tag == TAG_MAP:
+            kv = EMPTY_PMAP
+
+            for _ in range(self.read_count()):
+                k = self.read_str()
+                kv = kv.assoc(k, self.read_node())
+
+            return Map(kv)
+        elif tag == TAG_PAIR:
+            a = self.read_node()
+            return Pair(a, self.read_node())
+        elif tag == TAG_MSG:
+            verb = self.read_str()
+            return Msg(verb, self.read_node())
+        elif tag == TAG_SEND:
+            subj = self.read_node()
+            return Send(subj, self.read_node())
+        else:
+            raise CacheError()
+
+
+def decode(data, digest):
+    """Returns the program in data, raises CacheError unless it's a valid
+    cache for the source with this digest."""
+    header_size = len(MAGIC) + DIGEST_SIZE
+
+    if len(data) < header_size or not data.startswith(MAGIC):
+        raise CacheError()
+
+    if data[len(MAGIC) : header_size] != digest:
+        raise CacheError()
+
+    dec = Decoder(data, header_size)
+    node = dec.read_node()
+
+    if dec.pos != len(data):
+        raise CacheError()
+
+    return node
+
+
+def read_file(path):
+    try:
+        fd = os.open(path, os.O_RDONLY, 0)
+    except OSError:
+        return None
+
+    chunks = []
+
+    try:
+        while True:
+            chunk = os.read(fd, 65536)
+
+            if len(chunk) == 0:
+                break
+
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+
+    return "".join(chunks)
+
+
+def write_file(path, data):
+    # written aside and renamed so a concurrent run never sees half a file
+    tmp_path = path + ".tmp"
+
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        try:
+            while len(data) > 0:
+                n = os.write(fd, data)
+                data = data[n:]
+        finally:
+            os.close(fd)
+
+        os.rename(tmp_path, path)
+    except OSError:
+        # a cache we can't write only costs the next run a parse
+        pass
+
+
+def parse_cached(code, cache_path):
+    """Parses code, reusing the AST stored in cache_path if it was written
+    for the same source and storing it there otherwise."""
+    digest = source_digest(code)
+    data = read_file(cache_path)
+
+    if data is not None:
+        try:
+            return decode(data, digest)
+        except CacheError:
+            pass
+
+    expr = parse(code)
+
+    try:
+        write_file(cache_path, encode(expr, digest))
+    except CacheError:
+        pass
+
+    return expr
@@ -0,0 +1,317 @@
+from __future__ import print_function
+from rpython.rlib.jit import JitDriver
+from fatt_types import *
+from fatt_prelude import (
+    array_eval,
+    block_eval,
+    map_eval,
+    msg_eval,
+    nil_or,
+    nil_ternary,
+    pair_eval,
+    send_eval,
+    true_and,
+    true_ternary,
+)
+
+# Evaluates with an explicit continuation stack instead of the host's: the
+# builtin eval handlers of Block, Array, Map, Pair, Msg and Send and the
+# branches of ?, and, or are run by the machine, pushing a Cont for the work
+# left after each sub expression. Handler bodies are evaluated in the
+# continuation of their send, so tail calls don't grow the stack. Any other
+# handler is called as usual.
+
+EVAL = 0
+RETURN = 1
+
+
+class Cont(object):
+    def __init__(self, next):
+        self.next = next
+
+    def resume(self, machine, value):
+        # nothing left to do, the value goes on to the next continuation
+        machine.k = self.next
+        machine.ret(value)
+
+
+class BlockCont(Cont):
+    def __init__(self, next, block, i, e):
+        Cont.__init__(self, next)
+        self.block = block
+        self.i = i
+        self.e = e
+
+    def resume(self, machine, value):
+        items = self.block.items
+        i = self.i
+
+        if i == len(items) - 1:
+            # the last item is in the block's tail position
+            machine.k = self.next
+        else:
+            self.i = i + 1
+
+        machine.eval(items[i], self.e)
+
+
+class ArrayCont(Cont):
+    def __init__(self, next, items, e):
+        Cont.__init__(self, next)
+        self.items = items
+        self.values = []
+        self.e = e
+
+    def resume(self, machine, value):
+        self.values.append(value)
+
+        if len(self.values) == len(self.items):
+            machine.k = self.next
+            machine.ret(new_array(self.values))
+        else:
+            machine.eval(self.items[len(self.values)], self.e)
+
+
+class MapCont(Cont):
+    def __init__(self, next, leaves, e):
+        Cont.__init__(self, next)
+        self.leaves = leaves
+        self.i = 0
+        self.kv = EMPTY_PMAP
+        self.e = e
+
+    def resume(self, machine, value):
+        self.kv = self.kv.assoc(self.leaves[self.i].key, value)
+        self.i += 1
+
+        if self.i == len(self.leaves):
+            machine.k = self.next
+            machine.ret(Map(self.kv))
+        else:
+            machine.eval(self.leaves[self.i].value, self.e)
+
+
+class PairCont(Cont):
+    def __init__(self, next, pair, e):
+        Cont.__init__(self, next)
+        self.pair = pair
+        self.a = None
+        self.e = e
+
+    def resume(self, machine, value):
+        if self.a is None:
+            self.a = value
+            machine.eval(self.pair.b, self.e)
+        else:
+            machine.k = self.next
+            machine.ret(Pair(self.a, value))
+
+
+class MsgCont(Cont):
+    def __init__(self, next, verb):
+        Cont.__init__(self, next)
+        self.verb = verb
+
+    def resume(self, machine, value):
+        machine.k = self.next
+        machine.ret(Msg(self.verb, value))
+
+
+class SendCont(Cont):
+    """Evaluates the subject and then the message of a Send, then sends."""
+
+    def __init__(self, next, send, e):
+        Cont.__init__(self, next)
+        self.send = send
+        self.subj = None
+        self.e = e
+
+    def resume(self, machine, value):
+        if self.subj is None:
+            self.subj = value
+            machine.eval(self.send.msg, self.e)
+            return
+
+        subj = self.subj
+        machine.k = self.next
+
+        if isinstance(value, Msg):
+            e = self.e
+            handler = e.child_handler(subj, value.verb)
+
+            if handler is not None and not handler.needs_frame():
+                machine.ret(e.handle_frameless(handler, subj, value, value.verb))
+                return
+
+            e = (
+                e.down()
+                .set_up_limit()
+                .bind("it", subj)
+                .bind("that", value.obj)
+            )
+            machine.apply(self.send, value.verb, subj, value, e)
+        else:
+            val_type_expected(TYPE_MSG, value)
+
+
+def get_printable_location(node):
+    if node is None:
+        return "<return>"
+    else:
+        return node.to_str()
+
+
+cekdriver = JitDriver(
+    greens=["node"],
+    reds=["machine"],
+    get_printable_location=get_printable_location,
+    is_recursive=True,
+)
+
+
+class Machine(object):
+    def __init__(self, node, e):
+        self.mode = EVAL
+        self.node = node
+        self.e = e
+        self.value = NIL
+        self.k = None
+        # only the scheduler's machines stop when out of fuel, the ones
+        # natives start run on the host stack and must finish
+        self.preemptible = False
+
+    def eval(self, node, e):
+        self.mode = EVAL
+        self.node = node
+        self.e = e
+
+    def ret(self, value):
+        self.mode = RETURN
+        self.node = None
+        self.value = value
+
+    def run(self):
+        """Returns the value of the program, or None if it ran out of fuel:
+        everything left to do is in the machine, run resumes it."""
+        while True:
+            cekdriver.jit_merge_point(node=self.node, machine=self)
+
+            if meter.enabled and self.preemptible and meter.fuel <= 0:
+                return None
+
+            if self.mode == EVAL:
+                self.step_eval(self.node, self.e)
+            elif self.k is None:
+                return self.value
+            else:
+                self.k.resume(self, self.value)
+
+    def step_eval(self, node, e):
+        # literals evaluate to themselves unless their eval was rebound
+        if node.is_literal():
+            handler = e.lookup_handler(node.type, "eval")
+
+            if handler is not None and handler.is_self_eval():
+                self.ret(node)
+                return
+
+        self.apply(node, "eval", node, e.get_eval_msg(), e)
+
+    def apply(self, node, verb, s, m, e):
+        """Same as e.dispatch(node, verb, s, m) but leaves the result, or what
+        is left to compute it, in the machine."""
+        if dispatch_info.count_sends:
+            dispatch_info.sends += 1
+
+        if meter.enabled:
+            meter.charge()
+
+        handler = e.get_send_handler(s, verb)
+
+        if handler is None:
+            handler_not_found(s, m)
+        elif profiler.enabled:
+            self.ret(e.profile_handle(handler, s, m, verb))
+        elif handler.type is not TYPE_HANDLER:
+            # an AST bound with replies, its value is the send's
+            self.eval(handler, e)
+        elif isinstance(handler, Handler):
+            self.apply_builtin(handler, s, m, e)
+        else:
+            self.ret(handler.handle(s, m, e))
+
+    def apply_builtin(self, handler, s, m, e):
+        fn = handler.fn
+        obj = m.obj
+
+        if fn is send_eval:
+            assert isinstance(s, Send)
+            self.k = SendCont(self.k, s, e)
+            self.eval(s.subj, e)
+        elif fn is block_eval:
+            assert isinstance(s, Block)
+
+            if len(s.items) == 0:
+                self.ret(NIL)
+            else:
+                if len(s.items) > 1:
+                    self.k = BlockCont(self.k, s, 1, e)
+
+                self.eval(s.items[0], e)
+        elif fn is array_eval:
+            assert isinstance(s, Array)
+
+            if array_is_self_eval(s, e):
+                self.ret(s)
+                return
+
+            items = s.items()
+
+            if len(items) == 0:
+                self.ret(s)
+            else:
+                self.k = ArrayCont(self.k, items, e)
+                self.eval(items[0], e)
+        elif fn is map_eval:
+            assert isinstance(s, Map)
+            leaves = s.kv.leaves()
+
+            if len(leaves) == 0:
+                self.ret(s)
+            else:
+                self.k = MapCont(self.k, leaves, e)
+                self.eval(leaves[0].value, e)
+        elif fn is pair_eval:
+            assert isinstance(s, Pair)
+            self.k = PairCont(self.k, s, e)
+            self.eval(s.a, e)
+        elif fn is msg_eval:
+            assert isinstance(s, Msg)
+            self.k = MsgCont(self.k, s.verb)
+            self.eval(s.obj, e)
+        elif fn is true_ternary and isinstance(obj, Pair):
+            self.eval(obj.a, e)
+        elif fn is nil_ternary and isinstance(obj, Pair):
+            self.eval(obj.b, e)
+        elif fn is true_and or fn is nil_or:
+            self.eval(obj, e)
+        else:
+            self.ret(handler.handle(s, m, e))
+
+
+class CekEngine(Engine):
+    """Walks the tree like Engine, with the continuation on the heap so deep
+    recursion is only bounded by memory."""
+
+    def eval_program(self, node, e):
+        return Machine(node, e).run()
+
+    def eval_body(self, node, e):
+        return Machine(node, e).run()
+
+
+CEK_ENGINE = CekEngine()
+
+
+def use_cek():
+    engine_ref.engine = CEK_ENGINE
@@ -0,0 +1,231 @@
+from __future__ import print_function
+from fatt_types import *
+from fatt_prelude import PRELUDE_TYPES, ROOT_FRAME
+
+# the opt phase, like optPhase in fatt.phases.cli.js: sends on literals that
+# reach a builtin pure handler are replaced by their result before running.
+# Laters are never entered, their body is a value the program can look at.
+
+
+def fold_program(node, e):
+    """Returns node with its constant sends folded, as seen from frame e.
+
+    Nothing is folded if the program rebinds eval, or replies on something
+    we can't tell the verb of; otherwise verbs it rebinds are left alone.
+    """
+    rebound = {}
+
+    if not collect_rebound(node, rebound) or "eval" in rebound:
+        return node
+
+    folder = Folder(e, rebound)
+
+    for sym in PRELUDE_TYPES:
+        if not folder.is_builtin(sym, "eval"):
+            return node
+
+    return folder.fold(node)
+
+
+def collect_rebound(node, rebound):
+    """Adds the verbs replies sends in node can bind to rebound.
+
+    Returns False if some replies in node binds a verb we can't know.
+    """
+    if isinstance(node, Send):
+        msg = node.msg
+
+        if isinstance(msg, Msg) and msg.verb == "replies":
+            target = node.subj
+
+            if not isinstance(target, Later):
+                return False
+
+            target_send = target.lval
+
+            if not isinstance(target_send, Send):
+                return False
+
+            target_msg = target_send.msg
+
+            if not isinstance(target_msg, Msg):
+                return False
+
+            rebound[target_msg.verb] = True
+            return collect_rebound(target_send, rebound) and collect_rebound(
+                msg.obj, rebound
+            )
+
+        return collect_rebound(node.subj, rebound) and collect_rebound(msg, rebound)
+    elif isinstance(node, Msg):
+        if node.verb == "replies":
+            return False
+
+        return collect_rebound(node.obj, rebound)
+    elif isinstance(node, Later):
+        return collect_rebound(node.lval, rebound)
+    elif isinstance(node, Pair):
+        return collect_rebound(node.a, rebound) and collect_rebound(node.b, rebound)
+    elif isinstance(node, Block):
+        for item in node.items:
+            if not collect_rebound(item, rebound):
+                return False
+    elif isinstance(node, Array):
+        for item in node.items():
+            if not collect_rebound(item, rebound):
+                return False
+    elif isinstance(node, Map):
+        for v in node.kv.values():
+            if not collect_rebound(v, rebound):
+                return False
+
+    return True
+
+
+def is_closed(node):
+    """True if evaluating node has no effect and doesn't depend on the frame.
+
+    Evaluating its value again gives the same value, which is what the
+    ternary and and/or handlers do with the branch they pick.
+    """
+    if node.is_literal():
+        return True
+    elif isinstance(node, Pair):
+        return is_closed(node.a) and is_closed(node.b)
+    elif isinstance(node, Msg):
+        return is_closed(node.obj)
+    elif isinstance(node, Block):
+        for item in node.items:
+            if not is_closed(item):
+                return False
+
+        return len(node.items) > 0
+    elif isinstance(node, Array):
+        for item in node.items():
+            if not is_closed(item):
+                return False
+
+        return True
+    else:
+        return False
+
+
+def is_discardable(node):
+    # a Later evaluates to its body without running it
+    return isinstance(node, Later) or is_closed(node)
+
+
+def picked_value(node):
+    # the handler evaluates the branch in its own frame, only fold when
+    # that gives the same as evaluating it where the send was
+    if isinstance(node, Later):
+        if is_closed(node.lval):
+            return node.lval
+        else:
+            return None
+    elif is_closed(node):
+        return node
+    else:
+        return None
+
+
+class Folder(object):
+    def __init__(self, e, rebound):
+        self.e = e
+        self.rebound = rebound
+
+    def is_builtin(self, sym, verb):
+        if verb in self.rebound:
+            return False
+
+        proto = ROOT_FRAME.find_type(sym)
+        builtin = None if proto is None else proto.find(verb)
+        return builtin is not None and self.e.lookup_handler(sym, verb) is builtin
+
+    def fold(self, node):
+        if isinstance(node, Send):
+            return self.fold_send(node)
+        elif isinstance(node, Msg):
+            return Msg(node.verb, self.fold(node.obj))
+        elif isinstance(node, Pair):
+            return Pair(self.fold(node.a), self.fold(node.b))
+        elif isinstance(node, Block):
+            return Block([self.fold(item) for item in node.items])
+        elif isinstance(node, Array):
+            return new_array([self.fold(item) for item in node.items()])
+        elif isinstance(node, Map):
+            kv = EMPTY_PMAP
+
+            for leaf in node.kv.leaves():
+                kv = kv.assoc(leaf.key, self.fold(leaf.value))
+
+            return Map(kv)
+        else:
+            return node
+
+    def fold_send(self, node):
+        subj = self.fold(node.subj)
+        msg = node.msg
+
+        if not isinstance(msg, Msg):
+            return Send(subj, self.fold(msg))
+
+        obj = self.fold(msg.obj)
+
+        if subj.is_literal() and self.is_builtin(subj.type, msg.verb):
+            r = self.fold_literal_send(subj, msg.verb, obj)
+
+            if r is not None:
+                return r
+
+        return Send(subj, Msg(msg.verb, obj))
+
+    def fold_literal_send(self, subj, verb, obj):
+        handler = self.e.lookup_handler(subj.type, verb)
+
+        if isinstance(handler, BinOpHandler):
+            # mismatched operands are left for the run to report
+            if obj.is_literal() and handler.accepts(subj, obj):
+                return handler.apply_op(subj, obj)
+            else:
+                return None
+        elif isinstance(handler, BaseCompOpHandler):
+            if obj.is_literal() and handler.accepts(subj, obj):
+                return handler.handle(subj, Msg(verb, obj), self.e)
+            else:
+                return None
+        elif verb == "?":
+            if isinstance(obj, Later):
+                # "c ? @ a : b", the pair reaches the handler unevaluated and
+                # only the taken branch runs
+                p = obj.lval
+
+                if not isinstance(p, Pair):
+                    return None
+
+                taken = p.b if subj.is_nil() else p.a
+                return taken if is_closed(taken) else None
+            elif not isinstance(obj, Pair):
+                return None
+            elif subj.is_nil():
+                return self.pick(obj.b, obj.a)
+            else:
+                return self.pick(obj.a, obj.b)
+        elif verb == "and":
+            if subj.is_nil():
+                return subj if is_discardable(obj) else None
+            else:
+                return picked_value(obj)
+        elif verb == "or":
+            if subj.is_nil():
+                return picked_value(obj)
+            else:
+                return subj if is_discardable(obj) else None
+        else:
+            return None
+
+    def pick(self, taken, dropped):
+        if is_discardable(dropped):
+            return picked_value(taken)
+        else:
+            return None
@@ -1,111 +1,7 @@
-from rply import ParserGenerator, LexerGenerator, ParsingError
-from rply.token import BaseBox
+from rply import ParserGenerator, LexerGenerator, LexingError, ParsingError
+from rply.token import BaseBox, SourcePosition, Token
 import fatt_types as t
 
-
-class Int(BaseBox):
-    def __init__(self, value):
-        self.ival = value
-
-    def to_type(self):
-        return t.Int(self.ival)
-
-
-class Float(BaseBox):
-    def __init__(self, value):
-        self.fval = value
-
-    def to_type(self):
-        return t.Float(self.fval)
-
-
-class Str(BaseBox):
-    def __init__(self, value):
-        self.sval = value
-
-    def to_type(self):
-        return t.Str(self.sval)
-
-
-class Name(BaseBox):
-    def __init__(self, name):
-        self.name = name
-
-    def to_type(self):
-        return t.Name(self.name)
-
-
-class Later(BaseBox):
-    def __init__(self, value):
-        self.lval = value
-
-    def to_type(self):
-        return t.Later(self.lval.to_type())
-
-
-class Block(BaseBox):
-    def __init__(self, items):
-        self.items = items
-
-    def to_type(self):
-        return t.Block([v.to_type() for v in self.items])
-
-
-class Array(BaseBox):
-    def __init__(self, items):
-        self.aitems = items
-
-    def to_type(self):
-        return t.Array([v.to_type() for v in self.aitems])
-
-
-class Map(BaseBox):
-    def __init__(self, kv={}):
-        self.kv = kv
-
-    def to_type(self):
-        kv = {}
-        for k, v in self.kv.iteritems():
-            kv[k] = v.to_type()
-
-        return t.Map(kv)
-
-
-class Pair(BaseBox):
-    def __init__(self, a, b):
-        self.a = a
-        self.b = b
-
-    def to_type(self):
-        return t.Pair(self.a.to_type(), self.b.to_type())
-
-
-class Nil(BaseBox):
-    def to_type(self):
-        return t.NIL
-
-
-NIL = Nil()
-
-
-class Msg(BaseBox):
-    def __init__(self, verb, obj):
-        self.verb = verb
-        self.obj = obj
-
-    def to_type(self):
-        return t.Msg(self.verb, self.obj.to_type())
-
-
-class Send(BaseBox):
-    def __init__(self, subj, msg):
-        self.subj = subj
-        self.msg = msg
-
-    def to_type(self):
-        return t.Send(self.subj.to_type(), self.msg.to_type())
-
-
 lg = LexerGenerator()
 
 NAME_RE = r"[a-zA-Z][a-zA-Z0-9]*"
@@ -141,6 +37,65 @@ lg.ignore(r"[\s\r\n\t]+")
 
 lexer = lg.build()
 
+
+class LexerStream(object):
+    """Same as rply's LexerStream but keeps track of where the current line
+    starts instead of searching back for the previous newline on every
+    token, which made lexing long lines quadratic.
+
+    lineno and colno are where s starts in its source, for code cut out of
+    a bigger file."""
+
+    def __init__(self, lexer, s, lineno=1, colno=1):
+        self.lexer = lexer
+        self.s = s
+        self.idx = 0
+        self.lineno = lineno
+        self.line_start = 1 - colno
+
+    def __iter__(self):
+        return self
+
+    def _update_pos(self, match):
+        self.idx = match.end
+        last_nl = self.s.rfind("\n", match.start, match.end)
+
+        if last_nl >= 0:
+            self.lineno += self.s.count("\n", match.start, match.end)
+            self.line_start = last_nl + 1
+
+    def next(self):
+        while True:
+            if self.idx >= len(self.s):
+                raise StopIteration
+
+            for rule in self.lexer.ignore_rules:
+                match = rule.matches(self.s, self.idx)
+
+                if match:
+                    self._update_pos(match)
+                    break
+            else:
+                break
+
+        for rule in self.lexer.rules:
+            match = rule.matches(self.s, self.idx)
+
+            if match:
+                source_pos = SourcePosition(
+                    match.start, self.lineno, match.start - self.line_start + 1
+                )
+                self._update_pos(match)
+                return Token(rule.name, self.s[match.start : match.end], source_pos)
+
+        raise LexingError(
+            None, SourcePosition(self.idx, self.lineno, self.idx - self.line_start + 1)
+        )
+
+    def __next__(self):
+        return self.next()
+
+
 pg = ParserGenerator(
     [
         "opar",
@@ -159,15 +114,26 @@ pg = ParserGenerator(
         "oarray",
         "carray",
         "omap",
-    ]
+    ],
+    # LALR tables are cached on disk keyed by a hash of the grammar, so
+    # importing this module only builds them when the grammar changed
+    cache_id="fatt",
 )
 
 
+def as_type(box):
+    # make rpython happy, productions get and return boxes, values are Types
+    assert isinstance(box, t.Type)
+    return box
+
+
 class State(object):
     def __init__(self):
         pass
 
 
+# sequences use left recursive rules and append to the list built so far,
+# so parsing N items is linear and the parser stack doesn't grow with N
 class ValueList(BaseBox):
     def __init__(self, value):
         self.vlitems = value
@@ -188,22 +154,23 @@ def send_value(state, p):
 
 @pg.production("send : value msgs")
 def send_msgs(state, p):
-    r = p[0]
+    r = as_type(p[0])
 
     for msg in p[1].getitems():
-        r = Send(r, msg)
+        r = t.Send(r, msg)
 
     return r
 
 
 @pg.production("msgs : msg")
 def msgs_msg(state, p):
-    return ValueList([p[0]])
+    return ValueList([as_type(p[0])])
 
 
-@pg.production("msgs : msg msgs")
+@pg.production("msgs : msgs msg")
 def msgs_msgs(state, p):
-    return ValueList([p[0]] + p[1].getitems())
+    p[0].getitems().append(as_type(p[1]))
+    return p[0]
 
 
 @pg.production("value : pair_head")
@@ -218,7 +185,7 @@ def value_pair(state, p):
 
 @pg.production("pair : pair_head colon value")
 def pair(state, p):
-    return Pair(p[0], p[2])
+    return t.Pair(as_type(p[0]), as_type(p[2]))
 
 
 @pg.production("pair_head : scalar")
@@ -228,7 +195,7 @@ def pair_head_scalar(state, p):
 
 @pg.production("pair_head : at value")
 def pair_head_later(state, p):
-    return Later(p[1])
+    return t.Later(as_type(p[1]))
 
 
 @pg.production("pair_head : opar send cpar")
@@ -258,92 +225,95 @@ def pair_head_map(state, p):
 
 @pg.production("block : oblock exprs cblock")
 def block(state, p):
-    return Block(p[1].getitems())
+    # Block items are immutable, they can't share the list being grown
+    return t.Block([item for item in p[1].getitems()])
 
 
 @pg.production("array : oarray carray")
 def array_empty(state, p):
-    return Array([])
+    return t.new_array([])
 
 
 @pg.production("array : oarray exprs carray")
 def array(state, p):
-    return Array(p[1].getitems())
+    return t.new_array(p[1].getitems())
 
 
 @pg.production("map : omap cblock")
 def map_empty(state, p):
-    return Map({})
+    return t.Map()
 
 
 @pg.production("map : omap map_kvs cblock")
 def map(state, p):
-    r = {}
+    r = t.EMPTY_PMAP
 
     for pair in p[1].getitems():
         # make rpython happy
-        if isinstance(pair, Pair):
+        if isinstance(pair, t.Pair):
             k = pair.a
-            if isinstance(k, Str):
-                r[t.unquote_str(k.sval)] = pair.b
+            if isinstance(k, t.Str):
+                r = r.assoc(k.flatten(), pair.b)
 
-    return Map(r)
+    return t.Map(r)
 
 
 @pg.production("map_kvs : map_kv")
 def map_kvs_one(state, p):
-    return ValueList([p[0]])
+    return ValueList([as_type(p[0])])
 
 
-@pg.production("map_kvs : map_kv sep map_kvs")
+@pg.production("map_kvs : map_kvs sep map_kv")
 def map_kvs_many(state, p):
-    return ValueList([p[0]] + p[2].getitems())
+    p[0].getitems().append(as_type(p[2]))
+    return p[0]
 
 
 @pg.production("map_kv : string colon value")
 def map_kv(state, p):
-    return Pair(Str(p[0].getstr()), p[2])
+    return t.Pair(t.Str(t.unquote_str(p[0].getstr())), as_type(p[2]))
 
 
 @pg.production("exprs : send")
 def exprs_one(state, p):
-    return ValueList([p[0]])
+    return ValueList([as_type(p[0])])
 
 
-@pg.production("exprs : send sep exprs")
+@pg.production("exprs : exprs sep send")
 def exprs_many(state, p):
-    return ValueList([p[0]] + p[2].getitems())
+    p[0].getitems().append(as_type(p[2]))
+    return p[0]
 
 
 @pg.production("scalar : opar cpar")
 def scalar_nil(state, p):
-    return NIL
+    return t.NIL
 
 
 @pg.production("scalar : number")
 def scalar_integer(state, p):
-    return Int(int(p[0].getstr()))
+    return t.int_from_str(p[0].getstr())
 
 
 @pg.production("scalar : float")
 def scalar_float(state, p):
-    return Float(float(p[0].getstr()))
+    return t.Float(float(p[0].getstr()))
 
 
 @pg.production("scalar : string")
 def scalar_string(state, p):
-    return Str(t.unquote_str(p[0].getstr()))
+    return t.Str(t.unquote_str(p[0].getstr()))
 
 
 @pg.production("scalar : name")
 def scalar_name(state, p):
-    return Name(p[0].getstr())
+    return t.Name(p[0].getstr())
 
 
 # TODO: this allows variable names that aren't valid in the previous one
 @pg.production("scalar : verb")
 def scalar_name_from_verb(state, p):
-    return Name(p[0].getstr())
+    return t.Name(p[0].getstr())
 
 
 @pg.production("scalar : bslash msg")
@@ -353,12 +323,12 @@ def scalar_msg_quote(state, p):
 
 @pg.production("msg : verb value")
 def msg(state, p):
-    return Msg(p[0].getstr(), p[1])
+    return t.Msg(p[0].getstr(), as_type(p[1]))
 
 
 @pg.production("msg : name value")
 def msg_verb_is_name(state, p):
-    return Msg(p[0].getstr(), p[1])
+    return t.Msg(p[0].getstr(), as_type(p[1]))
 
 
 @pg.error
@@ -372,6 +342,6 @@ def error_handler(state, token):
 parser = pg.build()
 
 
-def parse(code):
+def parse(code, lineno=1, colno=1):
     state = State()
-    return parser.parse(lexer.lex(code), state)
+    return as_type(parser.parse(LexerStream(lexer, code, lineno, colno), state))
@@ -0,0 +1,381 @@
+from rpython.rlib.objectmodel import compute_hash
+from rpython.rlib.rarithmetic import intmask
+
+# Persistent vector and hash array mapped trie, as in Clojure: nodes have up
+# to 32 slots and updates copy the path to the changed slot, everything else
+# is shared with the previous version.
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+
+class VNode(object):
+    pass
+
+
+class VBranch(VNode):
+    _immutable_fields_ = ["children"]
+
+    def __init__(self, children):
+        self.children = children
+
+
+EMPTY_BRANCH = VBranch([])
+
+
+def new_path(shift, node):
+    while shift > 0:
+        node = VBranch([node])
+        shift -= BITS
+
+    return node
+
+
+def make_vector(name):
+    """Returns a persistent vector class, its empty vector and its
+    from_list for one type of values: each call makes new classes, so the
+    values of an IntVector stay unboxed ints."""
+
+    class VLeaf(VNode):
+        _immutable_fields_ = ["values"]
+
+        def __init__(self, values):
+            self.values = values
+
+    class PVector(object):
+        """Vector of up to 32 ** 6 values: the last ones live in tail, the
+        rest in a trie of leaves, shift is the level of its root."""
+
+        _immutable_fields_ = ["count", "shift", "root", "tail"]
+
+        def __init__(self, count, shift, root, tail):
+            self.count = count
+            self.shift = shift
+            self.root = root
+            self.tail = tail
+
+        def length(self):
+            return self.count
+
+        def tail_offset(self):
+            if self.count < WIDTH:
+                return 0
+
+            return ((self.count - 1) >> BITS) << BITS
+
+        def leaf_for(self, i):
+            node = self.root
+            level = self.shift
+
+            while level > 0:
+                assert isinstance(node, VBranch)
+                node = node.children[(i >> level) & MASK]
+                level -= BITS
+
+            assert isinstance(node, VLeaf)
+            return node.values
+
+        def get(self, i):
+            assert 0 <= i < self.count
+
+            if i >= self.tail_offset():
+                return self.tail[i - self.tail_offset()]
+
+            return self.leaf_for(i)[i & MASK]
+
+        def append(self, value):
+            if self.count - self.tail_offset() < WIDTH:
+                tail = self.tail[:]
+                tail.append(value)
+                return PVector(self.count + 1, self.shift, self.root, tail)
+
+            return self.push_leaf(VLeaf(self.tail), [value])
+
+        def push_leaf(self, leaf, tail):
+            # leaf holds the WIDTH values before tail, it goes into the trie
+            if (self.count >> BITS) > (1 << self.shift):
+                root = VBranch([self.root, new_path(self.shift, leaf)])
+                return PVector(self.count + len(tail), self.shift + BITS, root, tail)
+
+            root = self.push_tail(self.shift, self.root, leaf)
+            return PVector(self.count + len(tail), self.shift, root, tail)
+
+        def push_tail(self, level, parent, leaf):
+            assert isinstance(parent, VBranch)
+            i = ((self.count - 1) >> level) & MASK
+            children = parent.children[:]
+
+            if level == BITS:
+                child = leaf
+            elif i < len(children):
+                child = self.push_tail(level - BITS, children[i], leaf)
+            else:
+                child = new_path(level - BITS, leaf)
+
+            if i < len(children):
+                children[i] = child
+            else:
+                children.append(child)
+
+            return VBranch(children)
+
+        def set(self, i, value):
+            assert 0 <= i < self.count
+
+            if i >= self.tail_offset():
+                tail = self.tail[:]
+                tail[i - self.tail_offset()] = value
+                return PVector(self.count, self.shift, self.root, tail)
+
+            root = self.set_in(self.shift, self.root, i, value)
+            return PVector(self.count, self.shift, root, self.tail)
+
+        def set_in(self, level, node, i, value):
+            if level == 0:
+                assert isinstance(node, VLeaf)
+                values = node.values[:]
+                values[i & MASK] = value
+                return VLeaf(values)
+
+            assert isinstance(node, VBranch)
+            children = node.children[:]
+            j = (i >> level) & MASK
+            children[j] = self.set_in(level - BITS, children[j], i, value)
+            return VBranch(children)
+
+        def to_list(self):
+            r = []
+            i = 0
+            tail_offset = self.tail_offset()
+
+            while i < tail_offset:
+                r.extend(self.leaf_for(i))
+                i += WIDTH
+
+            r.extend(self.tail)
+            return r
+
+    empty = PVector(0, BITS, EMPTY_BRANCH, [])
+
+    def vector_from_list(items):
+        """Builds a vector a leaf at a time instead of a value at a time."""
+        vec = empty
+        n = len(items)
+        start = 0
+
+        while n - start > WIDTH:
+            end = start + WIDTH
+            assert start >= 0 and end >= 0
+            leaf = items[start:end]
+
+            if vec.count == 0:
+                vec = PVector(WIDTH, BITS, EMPTY_BRANCH, leaf)
+            else:
+                vec = vec.push_leaf(VLeaf(vec.tail), leaf)
+
+            start = end
+
+        assert start >= 0
+        tail = items[start:n]
+
+        if vec.count == 0:
+            return PVector(len(tail), BITS, EMPTY_BRANCH, tail)
+
+        return vec.push_leaf(VLeaf(vec.tail), tail)
+
+    VLeaf.__name__ = name + "Leaf"
+    PVector.__name__ = name
+    return PVector, empty, vector_from_list
+
+
+PVector, EMPTY_VECTOR, vector_from_list = make_vector("PVector")
+IntVector, EMPTY_INT_VECTOR, int_vector_from_list = make_vector("IntVector")
+FloatVector, EMPTY_FLOAT_VECTOR, float_vector_from_list = make_vector("FloatVector")
+
+
+def key_hash(key):
+    return intmask(compute_hash(key)) & 0xFFFFFFFF
+
+
+def bit_count(i):
+    i = i - ((i >> 1) & 0x55555555)
+    i = (i & 0x33333333) + ((i >> 2) & 0x33333333)
+    return (((i + (i >> 4)) & 0x0F0F0F0F) * 0x01010101 & 0xFFFFFFFF) >> 24
+
+
+class Added(object):
+    def __init__(self):
+        self.added = False
+
+
+class HNode(object):
+    def get(self, shift, hash, key):
+        return None
+
+    def assoc(self, shift, leaf, added):
+        return self
+
+    def collect(self, leaves):
+        pass
+
+
+class HLeaf(HNode):
+    _immutable_fields_ = ["hash", "key", "value"]
+
+    def __init__(self, hash, key, value):
+        self.hash = hash
+        self.key = key
+        self.value = value
+
+    def get(self, shift, hash, key):
+        if key == self.key:
+            return self
+
+        return None
+
+    def assoc(self, shift, leaf, added):
+        if leaf.key == self.key:
+            return leaf
+
+        added.added = True
+
+        if leaf.hash == self.hash:
+            return HCollision(self.hash, [self, leaf])
+
+        return merge_leaves(shift, self, leaf)
+
+    def collect(self, leaves):
+        leaves.append(self)
+
+
+class HCollision(HNode):
+    """Leaves whose keys have the same 32 bit hash."""
+
+    _immutable_fields_ = ["hash", "leaves"]
+
+    def __init__(self, hash, leaves):
+        self.hash = hash
+        self.leaves = leaves
+
+    def get(self, shift, hash, key):
+        for leaf in self.leaves:
+            if leaf.key == key:
+                return leaf
+
+        return None
+
+    def assoc(self, shift, leaf, added):
+        if leaf.hash != self.hash:
+            node = HBitmap(hash_bit(shift, self.hash), [self])
+            return node.assoc(shift, leaf, added)
+
+        leaves = self.leaves[:]
+
+        for i in range(len(leaves)):
+            if leaves[i].key == leaf.key:
+                leaves[i] = leaf
+                return HCollision(self.hash, leaves)
+
+        added.added = True
+        leaves.append(leaf)
+        return HCollision(self.hash, leaves)
+
+    def collect(self, leaves):
+        leaves.extend(self.leaves)
+
+
+def hash_bit(shift, hash):
+    return 1 << ((hash >> shift) & MASK)
+
+
+def merge_leaves(shift, a, b):
+    # a and b have different hashes, so they part ways at some level
+    bit_a = hash_bit(shift, a.hash)
+    bit_b = hash_bit(shift, b.hash)
+
+    if bit_a == bit_b:
+        return HBitmap(bit_a, [merge_leaves(shift + BITS, a, b)])
+    elif bit_a < bit_b:
+        return HBitmap(bit_a | bit_b, [a, b])
+    else:
+        return HBitmap(bit_a | bit_b, [b, a])
+
+
+class HBitmap(HNode):
+    """Up to 32 children, one per bit set in bitmap, in bit order."""
+
+    _immutable_fields_ = ["bitmap", "children"]
+
+    def __init__(self, bitmap, children):
+        self.bitmap = bitmap
+        self.children = children
+
+    def index(self, bit):
+        return bit_count(self.bitmap & (bit - 1))
+
+    def get(self, shift, hash, key):
+        bit = hash_bit(shift, hash)
+
+        if self.bitmap & bit == 0:
+            return None
+
+        return self.children[self.index(bit)].get(shift + BITS, hash, key)
+
+    def assoc(self, shift, leaf, added):
+        bit = hash_bit(shift, leaf.hash)
+        i = self.index(bit)
+
+        if self.bitmap & bit == 0:
+            added.added = True
+            children = self.children[:i] + [leaf] + self.children[i:]
+            return HBitmap(self.bitmap | bit, children)
+
+        children = self.children[:]
+        children[i] = children[i].assoc(shift + BITS, leaf, added)
+        return HBitmap(self.bitmap, children)
+
+    def collect(self, leaves):
+        for child in self.children:
+            child.collect(leaves)
+
+
+class PMap(object):
+    """Map from strings, get and assoc are O(log32 n)."""
+
+    _immutable_fields_ = ["count", "root"]
+
+    def __init__(self, count, root):
+        self.count = count
+        self.root = root
+
+    def length(self):
+        return self.count
+
+    def get(self, key):
+        leaf = self.root.get(0, key_hash(key), key)
+
+        if leaf is None:
+            return None
+
+        assert isinstance(leaf, HLeaf)
+        return leaf.value
+
+    def assoc(self, key, value):
+        added = Added()
+        root = self.root.assoc(0, HLeaf(key_hash(key), key, value), added)
+        return PMap(self.count + 1 if added.added else self.count, root)
+
+    def leaves(self):
+        r = []
+        self.root.collect(r)
+        return r
+
+    def keys(self):
+        return [leaf.key for leaf in self.leaves()]
+
+    def values(self):
+        return [leaf.value for leaf in self.leaves()]
+
+
+EMPTY_PMAP = PMap(0, HBitmap(0, []))
@@ -0,0 +1,440 @@
+from __future__ import print_function
+from fatt_types import *
+
+
+def name_lookup(s, _m, e):
+    assert isinstance(s, Name)
+    v = e.find(s.name)
+    if v is None:
+        fail("Name " + s.name + " not found")
+    else:
+        return v
+
+
+def name_is(s, m, e):
+    assert isinstance(s, Name)
+    e.up.bind(s.name, m.obj)
+    return m.obj
+
+
+def later_eval(s, m, e):
+    assert isinstance(s, Later)
+
+    if isinstance(s, Lazy):
+        # a thunk is a value, it's only run by force
+        return s
+
+    return s.lval
+
+
+def value_lazy(s, m, e):
+    if isinstance(s, Lazy):
+        return s
+
+    return Lazy(s, e.up)
+
+
+def value_force(s, m, e):
+    if isinstance(s, Lazy):
+        return s.force()
+
+    # anything else is evaluated again on every force
+    return engine_ref.engine.eval_body(s, e.up)
+
+
+def block_eval(s, m, e):
+    assert isinstance(s, Block)
+    r = NIL
+    for item in s.items:
+        r = e.eval(item)
+
+    return r
+
+
+def array_eval(s, m, e):
+    assert isinstance(s, Array)
+
+    if array_is_self_eval(s, e):
+        return s
+
+    r = []
+    for item in s.items():
+        r.append(e.eval(item))
+
+    return new_array(r)
+
+
+def map_eval(s, m, e):
+    assert isinstance(s, Map)
+    r = EMPTY_PMAP
+    for leaf in s.kv.leaves():
+        r = r.assoc(leaf.key, e.eval(leaf.value))
+
+    return Map(r)
+
+
+def array_get(s, m, e):
+    assert isinstance(s, Array)
+    i = m.obj
+
+    if isinstance(i, Int):
+        if 0 <= i.ival < s.length():
+            return s.get(i.ival)
+        else:
+            return NIL
+    elif i.is_int():
+        # a BigInt, too big for any index
+        return NIL
+    else:
+        val_type_expected(TYPE_INT, i)
+
+
+def array_append(s, m, e):
+    assert isinstance(s, Array)
+    return s.append(m.obj)
+
+
+def array_set(s, m, e):
+    assert isinstance(s, Array)
+    p = m.obj
+
+    if isinstance(p, Pair):
+        i = p.a
+
+        if isinstance(i, Int):
+            if 0 <= i.ival < s.length():
+                return s.set(i.ival, p.b)
+            elif i.ival == s.length():
+                return s.append(p.b)
+            else:
+                fail("Index out of range: " + i.to_str())
+        elif i.is_int():
+            fail("Index out of range: " + i.to_str())
+        else:
+            val_type_expected(TYPE_INT, i)
+    else:
+        val_type_expected(TYPE_PAIR, p)
+
+
+def array_size(s, m, e):
+    assert isinstance(s, Array)
+    return new_int(s.length())
+
+
+def map_get(s, m, e):
+    assert isinstance(s, Map)
+    k = m.obj
+
+    if isinstance(k, Str):
+        v = s.kv.get(k.flatten())
+
+        if v is None:
+            return NIL
+        else:
+            return v
+    else:
+        val_type_expected(TYPE_STR, k)
+
+
+def map_set(s, m, e):
+    assert isinstance(s, Map)
+    p = m.obj
+
+    if isinstance(p, Pair):
+        k = p.a
+
+        if isinstance(k, Str):
+            return Map(s.kv.assoc(k.flatten(), p.b))
+        else:
+            val_type_expected(TYPE_STR, k)
+    else:
+        val_type_expected(TYPE_PAIR, p)
+
+
+def map_size(s, m, e):
+    assert isinstance(s, Map)
+    return new_int(s.kv.length())
+
+
+def pair_eval(s, m, e):
+    assert isinstance(s, Pair)
+    return Pair(e.eval(s.a), e.eval(s.b))
+
+
+def msg_eval(s, _m, e):
+    assert isinstance(s, Msg)
+    return Msg(s.verb, e.eval(s.obj))
+
+
+def send_eval(s, m, e):
+    assert isinstance(s, Send)
+    subj = e.eval(s.subj)
+    return send_value(s, subj, e.eval(s.msg), e)
+
+
+def send_value(s, subj, msg, e):
+    if isinstance(msg, Msg):
+        handler = e.child_handler(subj, msg.verb)
+
+        if handler is not None and not handler.needs_frame():
+            return e.handle_frameless(handler, subj, msg, msg.verb)
+
+        return (
+            e.down()
+            .set_up_limit()
+            .bind("it", subj)
+            .bind("that", msg.obj)
+            .dispatch(s, msg.verb, subj, msg)
+        )
+    else:
+        val_type_expected(TYPE_MSG, msg)
+
+
+def send_replies(s, m, e):
+    assert isinstance(s, Send)
+    target = e.up.eval(s.subj)
+    msg = s.msg
+    assert isinstance(msg, Msg)
+    proto = e.up.find_type(target.type)
+
+    if proto is None:
+        fail("Prototype not found for type " + target.type.sym_name)
+    else:
+        proto.bind(msg.verb, m.obj)
+        return NIL
+
+
+def nil_ternary(s, m, e):
+    p = m.obj
+    if isinstance(p, Pair):
+        return e.eval(p.b)
+    else:
+        val_type_expected(TYPE_PAIR, p)
+
+
+def true_ternary(s, m, e):
+    p = m.obj
+    if isinstance(p, Pair):
+        return e.eval(p.a)
+    else:
+        val_type_expected(TYPE_PAIR, p)
+
+
+def nil_and(s, m, e):
+    return s
+
+
+def true_and(s, m, e):
+    return e.eval(m.obj)
+
+
+def nil_or(s, m, e):
+    return e.eval(m.obj)
+
+
+def true_or(s, m, e):
+    return s
+
+
+PRELUDE_TYPES = [
+    TYPE_NIL,
+    TYPE_INT,
+    TYPE_FLOAT,
+    TYPE_STR,
+    TYPE_LATER,
+    TYPE_BLOCK,
+    TYPE_PAIR,
+    TYPE_ARRAY,
+    TYPE_MAP,
+    TYPE_NAME,
+    TYPE_MSG,
+    TYPE_SEND,
+]
+
+
+def make_root_frame():
+    f = Frame()
+
+    nil_proto = Frame()
+    nil_proto.bind("eval", SELF_EVAL)
+
+    nil_proto.bind("<", nil_compop(lambda a, b: False))
+    nil_proto.bind("<=", nil_compop(lambda a, b: False))
+    nil_proto.bind(">", nil_compop(lambda a, b: False))
+    nil_proto.bind(">=", nil_compop(lambda a, b: False))
+    nil_proto.bind("=", nil_compop(lambda a, b: b.is_nil()))
+    nil_proto.bind("!=", nil_compop(lambda a, b: not b.is_nil()))
+
+    nil_proto.bind("?", Handler(nil_ternary))
+    nil_proto.bind("and", Handler(nil_and, False))
+    nil_proto.bind("or", Handler(nil_or))
+
+    int_proto = Frame()
+    int_proto.bind("eval", SELF_EVAL)
+
+    int_proto.bind("+", int_binop(INT_ADD))
+    int_proto.bind("-", int_binop(INT_SUB))
+    int_proto.bind("*", int_binop(INT_MUL))
+
+    int_proto.bind("<", int_compop(lambda a, b: a < b, lambda a, b: a.lt(b)))
+    int_proto.bind("<=", int_compop(lambda a, b: a <= b, lambda a, b: a.le(b)))
+    int_proto.bind(">", int_compop(lambda a, b: a > b, lambda a, b: a.gt(b)))
+    int_proto.bind(">=", int_compop(lambda a, b: a >= b, lambda a, b: a.ge(b)))
+    int_proto.bind("=", int_compop(lambda a, b: a == b, lambda a, b: a.eq(b)))
+    int_proto.bind("!=", int_compop(lambda a, b: a != b, lambda a, b: a.ne(b)))
+
+    int_proto.bind("?", Handler(true_ternary))
+    int_proto.bind("and", Handler(true_and))
+    int_proto.bind("or", Handler(true_or, False))
+
+    float_proto = Frame()
+    float_proto.bind("eval", SELF_EVAL)
+
+    float_proto.bind("+", float_binop(lambda a, b: a + b))
+    float_proto.bind("-", float_binop(lambda a, b: a - b))
+    float_proto.bind("*", float_binop(lambda a, b: a * b))
+    float_proto.bind("/", float_binop(lambda a, b: a / b))
+
+    float_proto.bind("<", float_compop(lambda a, b: a < b))
+    float_proto.bind("<=", float_compop(lambda a, b: a <= b))
+    float_proto.bind(">", float_compop(lambda a, b: a > b))
+    float_proto.bind(">=", float_compop(lambda a, b: a >= b))
+    float_proto.bind("=", float_compop(lambda a, b: a == b))
+    float_proto.bind("!=", float_compop(lambda a, b: a != b))
+
+    float_proto.bind("?", Handler(true_ternary))
+    float_proto.bind("and", Handler(true_and))
+    float_proto.bind("or", Handler(true_or, False))
+
+    str_proto = Frame()
+    str_proto.bind("eval", SELF_EVAL)
+
+    str_proto.bind("+", str_binop(concat_str))
+
+    str_proto.bind("<", str_compop(lambda a, b: a < b))
+    str_proto.bind("<=", str_compop(lambda a, b: a <= b))
+    str_proto.bind(">", str_compop(lambda a, b: a > b))
+    str_proto.bind(">=", str_compop(lambda a, b: a >= b))
+    str_proto.bind("=", str_compop(lambda a, b: a == b))
+    str_proto.bind("!=", str_compop(lambda a, b: a != b))
+
+    str_proto.bind("?", Handler(true_ternary))
+    str_proto.bind("and", Handler(true_and))
+    str_proto.bind("or", Handler(true_or, False))
+
+    name_proto = Frame()
+    name_proto.bind("eval", Handler(name_lookup))
+    name_proto.bind("is", Handler(name_is))
+
+    name_proto.bind("?", Handler(true_ternary))
+    name_proto.bind("and", Handler(true_and))
+    name_proto.bind("or", Handler(true_or, False))
+
+    later_proto = Frame()
+    later_proto.bind("eval", Handler(later_eval))
+
+    later_proto.bind("?", Handler(true_ternary))
+    later_proto.bind("and", Handler(true_and))
+    later_proto.bind("or", Handler(true_or, False))
+
+    block_proto = Frame()
+    block_proto.bind("eval", Handler(block_eval))
+
+    block_proto.bind("?", Handler(true_ternary))
+    block_proto.bind("and", Handler(true_and))
+    block_proto.bind("or", Handler(true_or, False))
+
+    pair_proto = Frame()
+    pair_proto.bind("eval", Handler(pair_eval))
+
+    pair_proto.bind("?", Handler(true_ternary))
+    pair_proto.bind("and", Handler(true_and))
+    pair_proto.bind("or", Handler(true_or, False))
+
+    array_proto = Frame()
+    array_proto.bind("eval", Handler(array_eval))
+    array_proto.bind(".", Handler(array_get, False))
+    array_proto.bind("append", Handler(array_append, False))
+    array_proto.bind("set", Handler(array_set, False))
+    array_proto.bind("size", Handler(array_size, False))
+
+    array_proto.bind("?", Handler(true_ternary))
+    array_proto.bind("and", Handler(true_and))
+    array_proto.bind("or", Handler(true_or, False))
+
+    map_proto = Frame()
+    map_proto.bind("eval", Handler(map_eval))
+    map_proto.bind(".", Handler(map_get, False))
+    map_proto.bind("set", Handler(map_set, False))
+    map_proto.bind("size", Handler(map_size, False))
+
+    map_proto.bind("?", Handler(true_ternary))
+    map_proto.bind("and", Handler(true_and))
+    map_proto.bind("or", Handler(true_or, False))
+
+    msg_proto = Frame()
+    msg_proto.bind("eval", Handler(msg_eval))
+
+    msg_proto.bind("?", Handler(true_ternary))
+    msg_proto.bind("and", Handler(true_and))
+    msg_proto.bind("or", Handler(true_or, False))
+
+    send_proto = Frame()
+    send_proto.bind("eval", Handler(send_eval))
+    send_proto.bind("replies", Handler(send_replies))
+
+    send_proto.bind("?", Handler(true_ternary))
+    send_proto.bind("and", Handler(true_and))
+    send_proto.bind("or", Handler(true_or, False))
+
+    # @(...) lazy () defers the expression in it until forced, once
+    for proto in [
+        nil_proto,
+        int_proto,
+        float_proto,
+        str_proto,
+        later_proto,
+        block_proto,
+        pair_proto,
+        array_proto,
+        map_proto,
+        name_proto,
+        msg_proto,
+        send_proto,
+    ]:
+        proto.bind("lazy", Handler(value_lazy))
+        proto.bind("force", Handler(value_force))
+
+    f.bind_type(TYPE_NIL, nil_proto)
+    f.bind_type(TYPE_INT, int_proto)
+    f.bind_type(TYPE_FLOAT, float_proto)
+    f.bind_type(TYPE_STR, str_proto)
+    f.bind_type(TYPE_LATER, later_proto)
+    f.bind_type(TYPE_BLOCK, block_proto)
+    f.bind_type(TYPE_PAIR, pair_proto)
+    f.bind_type(TYPE_ARRAY, array_proto)
+    f.bind_type(TYPE_MAP, map_proto)
+    f.bind_type(TYPE_NAME, name_proto)
+    f.bind_type(TYPE_MSG, msg_proto)
+    f.bind_type(TYPE_SEND, send_proto)
+
+    return f
+
+
+# built at import time, so in a translated binary the whole prelude is a
+# prebuilt constant and no prototype is constructed at startup
+ROOT_FRAME = make_root_frame()
+
+
+def new_program_frame():
+    """Returns a frame for one program evaluated against ROOT_FRAME.
+
+    Each prototype is overlaid with an empty frame, so handlers bound with
+    replies stay in this program instead of leaking into the shared root.
+    """
+    types = ROOT_FRAME.type_table()[:]
+
+    for sym in PRELUDE_TYPES:
+        types[sym.sym_id] = Frame(types[sym.sym_id])
+
+    return ROOT_FRAME.right().init_types(types).right().down()
@@ -0,0 +1,161 @@
+from __future__ import print_function
+import os
+import time
+from rpython.rlib.listsort import make_timsort_class
+
+
+class VerbStats(object):
+    def __init__(self, key):
+        self.key = key
+        self.count = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.allocs = 0
+        # calls of this key in progress, recursive ones count inclusive once
+        self.active = 0
+
+
+class Call(object):
+    def __init__(self, stats, path, start, allocs):
+        self.stats = stats
+        self.path = path
+        self.start = start
+        self.allocs = allocs
+        self.child_time = 0.0
+        self.child_allocs = 0
+
+
+# slowest first
+StatsSort = make_timsort_class(lt=lambda a, b: a.exclusive > b.exclusive)
+
+
+# rpython strings have no ljust/rjust
+def left(s, width):
+    if len(s) >= width:
+        return s + " "
+
+    return s + " " * (width - len(s))
+
+
+def right(s, width):
+    if len(s) >= width:
+        return " " + s
+
+    return " " * (width - len(s)) + s
+
+
+def write_all(fd, data):
+    while len(data) > 0:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+class Profiler(object):
+    """Per (type, verb) send stats and a fatt level call stack, --profile.
+
+    Frame.dispatch and Type.__init__ only check enabled, which is
+    quasi-immutable: with profiling off the JIT removes the checks.
+    """
+
+    _immutable_fields_ = ["enabled?"]
+
+    def __init__(self):
+        self.enabled = False
+        self.allocs = 0
+        self.stats = {}
+        self.calls = []
+        # collapsed stack, "a;b;c" -> exclusive microseconds, for flamegraph.pl
+        self.folded = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def get_stats(self, key):
+        stats = self.stats.get(key, None)
+
+        if stats is None:
+            stats = VerbStats(key)
+            self.stats[key] = stats
+
+        return stats
+
+    def enter(self, type_name, verb):
+        key = type_name + " " + verb
+        stats = self.get_stats(key)
+        stats.count += 1
+        stats.active += 1
+
+        if len(self.calls) > 0:
+            path = self.calls[-1].path
+        else:
+            path = "<program>"
+
+        # the stack shows messages, the evals in between are in the stats
+        if verb != "eval":
+            path = path + ";" + key
+
+        self.calls.append(Call(stats, path, time.time(), self.allocs))
+
+    def leave(self):
+        call = self.calls.pop()
+        stats = call.stats
+        elapsed = time.time() - call.start
+        allocs = self.allocs - call.allocs
+        exclusive = elapsed - call.child_time
+
+        stats.active -= 1
+
+        if stats.active == 0:
+            stats.inclusive += elapsed
+
+        stats.exclusive += exclusive
+        stats.allocs += allocs - call.child_allocs
+        self.folded[call.path] = self.folded.get(call.path, 0) + int(exclusive * 1e6)
+
+        if len(self.calls) > 0:
+            parent = self.calls[-1]
+            parent.child_time += elapsed
+            parent.child_allocs += allocs
+
+    def report(self, folded_path):
+        """Prints the stats sorted by exclusive time to stderr and writes the
+        collapsed stacks to folded_path."""
+        all_stats = self.stats.values()
+        StatsSort(all_stats).sort()
+        lines = [
+            left("type verb", 24)
+            + right("sends", 10)
+            + right("incl us", 14)
+            + right("excl us", 14)
+            + right("allocs", 10)
+        ]
+
+        for stats in all_stats:
+            lines.append(
+                left(stats.key, 24)
+                + right(str(stats.count), 10)
+                + right(str(int(stats.inclusive * 1e6)), 14)
+                + right(str(int(stats.exclusive * 1e6)), 14)
+                + right(str(stats.allocs), 10)
+            )
+
+        write_all(2, "\n".join(lines) + "\n")
+        out = []
+
+        for path, micros in self.folded.iteritems():
+            if micros > 0:
+                out.append(path + " " + str(micros) + "\n")
+
+        try:
+            fd = os.open(folded_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        except OSError:
+            write_all(2, "Error: can't write " + folded_path + "\n")
+            return
+
+        try:
+            write_all(fd, "".join(out))
+        finally:
+            os.close(fd)
+
+
+profiler = Profiler()
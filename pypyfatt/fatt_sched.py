@@ -0,0 +1,87 @@
+from __future__ import print_function
+import time
+from fatt_types import *
+from fatt_cek import Machine
+
+
+class Task(object):
+    def __init__(self, index, machine):
+        self.index = index
+        self.machine = machine
+        self.sends = 0
+        # seconds spent running it, time waiting for its turn doesn't count
+        self.elapsed = 0.0
+
+
+class Scheduler(object):
+    """Runs programs as green threads on fatt_cek machines, round robin.
+
+    Each task runs until it has made quantum sends, then it's put back at
+    the end of the queue with its continuation in its machine. A task that
+    makes more than send_limit sends or runs for more than time_limit
+    seconds fails, -1 is no limit. Sends made by natives that evaluate on
+    the host stack, like force, can't be interrupted and may overrun the
+    quantum, they're still charged.
+    """
+
+    def __init__(self, quantum, send_limit, time_limit):
+        self.quantum = quantum
+        self.send_limit = send_limit
+        self.time_limit = time_limit
+        self.ready = []
+        self.spawned = 0
+
+    def spawn(self, expr, e):
+        machine = Machine(expr, e)
+        machine.preemptible = True
+        task = Task(self.spawned, machine)
+        self.spawned += 1
+        self.ready.append(task)
+        return task
+
+    def run_slice(self, task):
+        meter.fuel = self.quantum
+        meter.sends = task.sends
+        meter.send_limit = self.send_limit
+        start = time.time()
+
+        if self.time_limit >= 0.0:
+            meter.deadline = start + self.time_limit - task.elapsed
+        else:
+            meter.deadline = -1.0
+
+        try:
+            value = task.machine.run()
+        finally:
+            task.sends = meter.sends
+            task.elapsed += time.time() - start
+
+        if value is None and self.time_limit >= 0.0:
+            if task.elapsed > self.time_limit:
+                fail("Time limit exceeded")
+
+        return value
+
+    def run(self, reporter):
+        """Runs the tasks until all are done, calling reporter.done with each
+        one and its value or reporter.failed with the error that stopped it,
+        in the order they finish."""
+        meter.enabled = True
+
+        while len(self.ready) > 0:
+            # a round gives every task a slice, the ones not done go to the
+            # next round in the same order
+            tasks = self.ready
+            self.ready = []
+
+            for task in tasks:
+                try:
+                    value = self.run_slice(task)
+                except Exception as err:
+                    reporter.failed(task, err)
+                    continue
+
+                if value is None:
+                    self.ready.append(task)
+                else:
+                    reporter.done(task, value)
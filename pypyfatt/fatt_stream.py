@@ -0,0 +1,101 @@
+from __future__ import print_function
+import os
+from rpython.rlib import rmmap
+from rpython.rlib.rarithmetic import intmask
+
+
+class StatementReader(object):
+    """Cuts the top level comma separated statements out of a mapped file.
+
+    Only the statement being returned is copied out of the map, so running
+    a file needs memory for its largest statement, not for all of it.
+    """
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.pos = 0
+        self.lineno = 1
+        self.line_start = 0
+        self.done = False
+        # where the last statement returned by next starts
+        self.stmt_lineno = 1
+        self.stmt_colno = 1
+
+    def advance(self):
+        if self.data.getitem(self.pos) == "\n":
+            self.lineno += 1
+            self.line_start = self.pos + 1
+
+        self.pos += 1
+
+    def next(self):
+        """Returns the source of the next statement, None after the last one.
+
+        A file without commas is a single statement, an empty one is an
+        empty statement so it reports the same error as an empty program.
+        """
+        if self.done:
+            return None
+
+        start = self.pos
+        self.stmt_lineno = self.lineno
+        self.stmt_colno = start - self.line_start + 1
+        depth = 0
+        in_str = False
+
+        while self.pos < self.size:
+            c = self.data.getitem(self.pos)
+
+            if in_str:
+                if c == "\\" and self.pos + 1 < self.size:
+                    self.advance()
+                elif c == '"':
+                    in_str = False
+            elif c == '"':
+                in_str = True
+            elif c == "(" or c == "[" or c == "{":
+                depth += 1
+            elif c == ")" or c == "]" or c == "}":
+                depth -= 1
+            elif c == "," and depth == 0:
+                end = self.pos
+                self.advance()
+                return self.data.getslice(start, end - start)
+
+            self.advance()
+
+        self.done = True
+
+        if self.size == 0:
+            return ""
+
+        return self.data.getslice(start, self.size - start)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+def open_statements(path):
+    """Returns a StatementReader over the file at path mapped read only, None
+    if it can't be opened."""
+    try:
+        fd = os.open(path, os.O_RDONLY, 0)
+    except OSError:
+        return None
+
+    try:
+        size = intmask(os.fstat(fd).st_size)
+
+        if size == 0:
+            # empty files can't be mapped, there's nothing to read anyway
+            return StatementReader(None, 0)
+
+        # the map keeps its own dup of fd, ours can be closed
+        return StatementReader(rmmap.mmap(fd, size, access=rmmap.ACCESS_READ), size)
+    except (OSError, rmmap.RMMapError, rmmap.RValueError):
+        return None
+    finally:
+        os.close(fd)
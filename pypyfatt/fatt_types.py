@@ -1,19 +1,55 @@
 from __future__ import print_function
+import time
+
+from rpython.rlib import rerased
+from rpython.rlib.jit import JitDriver, elidable, promote, unroll_safe, we_are_jitted
+from rpython.rlib.rarithmetic import ovfcheck, string_to_int
+from rpython.rlib.rbigint import rbigint
+from rpython.rlib.rstring import ParseStringOverflowError, StringBuilder
+from rply.token import BaseBox
+from fatt_profile import profiler
+from fatt_persistent import (
+    EMPTY_PMAP,
+    EMPTY_VECTOR,
+    float_vector_from_list,
+    int_vector_from_list,
+    vector_from_list,
+)
+
+
+def get_printable_location(node, verb):
+    if node is None:
+        return "<send> " + verb
+    else:
+        return node.to_str() + " " + verb
+
+
+# greens are the AST node that triggered the send and the verb, both are
+# constant for a given place in the program, the values flowing through are reds
+jitdriver = JitDriver(
+    greens=["node", "verb"],
+    reds=["s", "m", "e"],
+    get_printable_location=get_printable_location,
+    is_recursive=True,
+)
+
+
+# a BaseBox so parser productions can build runtime values directly
+class Type(BaseBox):
+    _immutable_fields_ = ["type"]
 
-from rpython.rlib.jit import JitDriver
-
-jitdriver = JitDriver(greens=["s", "m"], reds=["e"], is_recursive=True)
-
-
-class Type(object):
     def __init__(self, type):
+        if profiler.enabled:
+            profiler.allocs += 1
+
         self.type = type
 
     def to_str(self):
         return self.type.sym_name
 
     def handle(self, _s, _m, e):
-        return e.eval(self)
+        # an AST bound as a handler, e.g. with replies
+        return engine_ref.engine.eval_body(self, e)
 
     def is_int(self):
         return False
@@ -27,11 +63,40 @@ class Type(object):
     def is_nil(self):
         return False
 
+    def is_literal(self):
+        return False
+
+    def is_self_eval(self):
+        return False
+
+    def needs_frame(self):
+        # as a handler, whether it looks at the frame of its send, natives
+        # that only use the subject and message don't get one
+        return True
+
+
+class SymbolIds(object):
+    def __init__(self):
+        self.next_id = 0
+
+    def new_id(self):
+        sym_id = self.next_id
+        self.next_id += 1
+        return sym_id
+
+
+symbol_ids = SymbolIds()
+
 
 class Symbol(Type):
+    """A type, sym_id is its dense index in type tables and dispatch caches."""
+
+    _immutable_fields_ = ["sym_name", "sym_id"]
+
     def __init__(self, sym_name):
         Type.__init__(self, self)
         self.sym_name = sym_name
+        self.sym_id = symbol_ids.new_id()
 
 
 TYPE_NIL = Symbol("Nil")
@@ -51,15 +116,42 @@ TYPE_HANDLER = Symbol("Handler")
 
 
 class Handler(Type):
-    def __init__(self, fn):
+    _immutable_fields_ = ["fn", "uses_frame"]
+
+    def __init__(self, fn, uses_frame=True):
         Type.__init__(self, TYPE_HANDLER)
         self.fn = fn
+        self.uses_frame = uses_frame
 
     def handle(self, s, m, e):
         return self.fn(s, m, e)
 
+    def needs_frame(self):
+        return self.uses_frame
+
+
+class SelfEvalHandler(Type):
+    """eval handler for values that evaluate to themselves."""
+
+    def __init__(self):
+        Type.__init__(self, TYPE_HANDLER)
+
+    def handle(self, s, m, e):
+        return s
+
+    def is_self_eval(self):
+        return True
+
+    def needs_frame(self):
+        return False
+
+
+SELF_EVAL = SelfEvalHandler()
+
 
 class Int(Type):
+    _immutable_fields_ = ["ival"]
+
     def __init__(self, value):
         Type.__init__(self, TYPE_INT)
         self.ival = value
@@ -70,8 +162,69 @@ class Int(Type):
     def is_int(self):
         return True
 
+    def is_literal(self):
+        return True
+
+
+SMALL_INT_MIN = -5
+SMALL_INT_MAX = 1024
+SMALL_INTS = [Int(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
+
+
+def new_int(value):
+    # traced code removes short lived boxes by itself, the cache would only
+    # turn them into reads from a prebuilt list
+    if not we_are_jitted() and SMALL_INT_MIN <= value <= SMALL_INT_MAX:
+        return SMALL_INTS[value - SMALL_INT_MIN]
+    else:
+        return Int(value)
+
+
+class BigInt(Type):
+    """An Int that doesn't fit in a machine word, made by new_big_int so
+    every value that fits is an Int."""
+
+    _immutable_fields_ = ["bval"]
+
+    def __init__(self, value):
+        Type.__init__(self, TYPE_INT)
+        self.bval = value
+
+    def to_str(self):
+        return self.bval.str()
+
+    def is_int(self):
+        return True
+
+    def is_literal(self):
+        return True
+
+
+def new_big_int(value):
+    try:
+        return new_int(value.toint())
+    except OverflowError:
+        return BigInt(value)
+
+
+def int_from_str(s):
+    try:
+        return new_int(string_to_int(s, 10))
+    except ParseStringOverflowError:
+        return new_big_int(rbigint.fromdecimalstr(s))
+
+
+def to_rbigint(v):
+    if isinstance(v, Int):
+        return rbigint.fromint(v.ival)
+    else:
+        assert isinstance(v, BigInt)
+        return v.bval
+
 
 class Float(Type):
+    _immutable_fields_ = ["fval"]
+
     def __init__(self, value):
         Type.__init__(self, TYPE_FLOAT)
         self.fval = value
@@ -82,20 +235,61 @@ class Float(Type):
     def is_float(self):
         return True
 
+    def is_literal(self):
+        return True
+
 
 class Str(Type):
+    """A flat string in sval or a rope, the concatenation of left and right.
+
+    Ropes are flattened the first time their characters are needed, so
+    gluing n strings together is O(n) however they're nested.
+    """
+
+    _immutable_fields_ = ["length"]
+
     def __init__(self, value):
         Type.__init__(self, TYPE_STR)
         self.sval = value
+        self.length = len(value)
+        self.left = None
+        self.right = None
+
+    def flatten(self):
+        if self.sval is None:
+            b = StringBuilder(self.length)
+            # ropes built by appending are as deep as they are long
+            stack = [self]
+
+            while len(stack) > 0:
+                node = stack.pop()
+                assert node is not None
+
+                if node.sval is not None:
+                    b.append(node.sval)
+                else:
+                    stack.append(node.right)
+                    stack.append(node.left)
+
+            self.sval = b.build()
+            self.left = None
+            self.right = None
+
+        return self.sval
 
     def to_str(self):
-        return quote_str(self.sval)
+        return quote_str(self.flatten())
 
     def is_str(self):
         return True
 
+    def is_literal(self):
+        return True
+
 
 class Name(Type):
+    _immutable_fields_ = ["name"]
+
     def __init__(self, name):
         Type.__init__(self, TYPE_NAME)
         self.name = name
@@ -105,6 +299,8 @@ class Name(Type):
 
 
 class Later(Type):
+    _immutable_fields_ = ["lval"]
+
     def __init__(self, value):
         Type.__init__(self, TYPE_LATER)
         self.lval = value
@@ -113,7 +309,29 @@ class Later(Type):
         return "@(" + self.lval.to_str() + ")"
 
 
+class Lazy(Later):
+    """A Later made by lazy, evaluated in the frame it was made in the first
+    time it's forced, later forces return that value."""
+
+    def __init__(self, value, frame):
+        Later.__init__(self, value)
+        self.frame = frame
+        self.forced = None
+
+    def force(self):
+        if self.forced is None:
+            frame = self.frame
+            assert frame is not None
+            self.forced = engine_ref.engine.eval_body(self.lval, frame)
+            # the value is all it needs from now on
+            self.frame = None
+
+        return self.forced
+
+
 class Block(Type):
+    _immutable_fields_ = ["items[*]"]
+
     def __init__(self, items):
         Type.__init__(self, TYPE_BLOCK)
         self.items = items
@@ -126,27 +344,241 @@ class Block(Type):
 
 
 class Array(Type):
-    def __init__(self, items):
+    """Values in a persistent vector, updates return a new Array sharing most
+    of it. How they're stored is up to strategy, storage is its vector."""
+
+    _immutable_fields_ = ["strategy", "storage"]
+
+    def __init__(self, strategy, storage):
         Type.__init__(self, TYPE_ARRAY)
-        self.aitems = items
+        self.strategy = strategy
+        self.storage = storage
+
+    def items(self):
+        return self.strategy.items(self)
+
+    def length(self):
+        return self.strategy.length(self)
+
+    def get(self, i):
+        return self.strategy.get(self, i)
+
+    def append(self, value):
+        return self.strategy.append(self, value)
+
+    def set(self, i, value):
+        return self.strategy.set(self, i, value)
 
     def to_str(self):
         r = []
-        for item in self.aitems:
+        for item in self.items():
             r.append(item.to_str())
         return "[" + ", ".join(r) + "]"
 
 
+class ArrayStrategy(object):
+    """Like PyPy's list strategies: arrays of only Ints or only Floats keep
+    them unboxed and box on access, adding any other value switches the new
+    array to ObjectArrayStrategy."""
+
+    # the type all items have if they're unboxed, it's None otherwise
+    item_type = None
+
+    def items(self, a):
+        return []
+
+    def length(self, a):
+        return 0
+
+    def get(self, a, i):
+        # callers check i against length first
+        return NIL
+
+    def append(self, a, value):
+        return a
+
+    def set(self, a, i, value):
+        return a
+
+
+erase_objects, unerase_objects = rerased.new_erasing_pair("objects")
+erase_ints, unerase_ints = rerased.new_erasing_pair("ints")
+erase_floats, unerase_floats = rerased.new_erasing_pair("floats")
+
+
+class ObjectArrayStrategy(ArrayStrategy):
+    def items(self, a):
+        return unerase_objects(a.storage).to_list()
+
+    def length(self, a):
+        return unerase_objects(a.storage).length()
+
+    def get(self, a, i):
+        return unerase_objects(a.storage).get(i)
+
+    def append(self, a, value):
+        return Array(self, erase_objects(unerase_objects(a.storage).append(value)))
+
+    def set(self, a, i, value):
+        vec = unerase_objects(a.storage).set(i, value)
+        return Array(self, erase_objects(vec))
+
+
+class IntArrayStrategy(ArrayStrategy):
+    item_type = TYPE_INT
+
+    def items(self, a):
+        return [new_int(v) for v in unerase_ints(a.storage).to_list()]
+
+    def length(self, a):
+        return unerase_ints(a.storage).length()
+
+    def get(self, a, i):
+        return new_int(unerase_ints(a.storage).get(i))
+
+    def append(self, a, value):
+        if isinstance(value, Int):
+            vec = unerase_ints(a.storage).append(value.ival)
+            return Array(self, erase_ints(vec))
+
+        return generalize_array(a).append(value)
+
+    def set(self, a, i, value):
+        if isinstance(value, Int):
+            vec = unerase_ints(a.storage).set(i, value.ival)
+            return Array(self, erase_ints(vec))
+
+        return generalize_array(a).set(i, value)
+
+
+class FloatArrayStrategy(ArrayStrategy):
+    item_type = TYPE_FLOAT
+
+    def items(self, a):
+        return [Float(v) for v in unerase_floats(a.storage).to_list()]
+
+    def length(self, a):
+        return unerase_floats(a.storage).length()
+
+    def get(self, a, i):
+        return Float(unerase_floats(a.storage).get(i))
+
+    def append(self, a, value):
+        if isinstance(value, Float):
+            vec = unerase_floats(a.storage).append(value.fval)
+            return Array(self, erase_floats(vec))
+
+        return generalize_array(a).append(value)
+
+    def set(self, a, i, value):
+        if isinstance(value, Float):
+            vec = unerase_floats(a.storage).set(i, value.fval)
+            return Array(self, erase_floats(vec))
+
+        return generalize_array(a).set(i, value)
+
+
+class EmptyArrayStrategy(ArrayStrategy):
+    """The strategy of [], the first value appended picks the next one."""
+
+    def append(self, a, value):
+        return new_array([value])
+
+
+OBJECT_ARRAY = ObjectArrayStrategy()
+INT_ARRAY = IntArrayStrategy()
+FLOAT_ARRAY = FloatArrayStrategy()
+EMPTY_ARRAY = EmptyArrayStrategy()
+
+
+def generalize_array(a):
+    return Array(OBJECT_ARRAY, erase_objects(vector_from_list(a.items())))
+
+
+def new_array(items):
+    if len(items) == 0:
+        return Array(EMPTY_ARRAY, erase_objects(EMPTY_VECTOR))
+
+    all_ints = True
+    all_floats = True
+
+    for item in items:
+        all_ints = all_ints and isinstance(item, Int)
+        all_floats = all_floats and isinstance(item, Float)
+
+    if all_ints:
+        ints = [0] * len(items)
+
+        for i in range(len(items)):
+            item = items[i]
+            assert isinstance(item, Int)
+            ints[i] = item.ival
+
+        return Array(INT_ARRAY, erase_ints(int_vector_from_list(ints)))
+    elif all_floats:
+        floats = [0.0] * len(items)
+
+        for i in range(len(items)):
+            item = items[i]
+            assert isinstance(item, Float)
+            floats[i] = item.fval
+
+        return Array(FLOAT_ARRAY, erase_floats(float_vector_from_list(floats)))
+
+    return Array(OBJECT_ARRAY, erase_objects(vector_from_list(items)))
+
+
+def array_is_self_eval(a, e):
+    """Whether evaluating a gives back a: its items are unboxed literals and
+    their eval is the builtin one."""
+    sym = a.strategy.item_type
+
+    if sym is None:
+        return False
+
+    handler = e.lookup_handler(sym, "eval")
+    return handler is not None and handler.is_self_eval()
+
+
+# concatenations up to this long are copied instead of making a rope
+ROPE_MIN_LENGTH = 64
+
+
+def concat_str(a, b):
+    if a.length == 0:
+        return b
+    elif b.length == 0:
+        return a
+    elif a.length + b.length <= ROPE_MIN_LENGTH:
+        return Str(a.flatten() + b.flatten())
+
+    r = Str("")
+    r.sval = None
+    r.length = a.length + b.length
+    r.left = a
+    r.right = b
+    return r
+
+
 def quote_str(s):
-    r = []
+    if s.find('"') < 0 and s.find("\\") < 0:
+        return '"' + s + '"'
 
-    for c in s:
-        if c == '"' or c == "\\":
-            r.append("\\")
+    b = StringBuilder(len(s) + 8)
+    b.append('"')
+    start = 0
+
+    for i in range(len(s)):
+        c = s[i]
 
-        r.append(c)
+        if c == '"' or c == "\\":
+            b.append_slice(s, start, i)
+            b.append("\\")
+            start = i
 
-    return '"' + "".join(r) + '"'
+    b.append_slice(s, start, len(s))
+    b.append('"')
+    return b.build()
 
 
 def unquote_str(s):
@@ -162,20 +594,25 @@ def unquote_str(s):
 
 
 class Map(Type):
-    def __init__(self, kv={}):
+    _immutable_fields_ = ["kv"]
+
+    def __init__(self, kv=EMPTY_PMAP):
         Type.__init__(self, TYPE_MAP)
+        # a PMap from str, updates return a new Map sharing most of it
         self.kv = kv
 
     def to_str(self):
         r = []
 
-        for k, v in self.kv.iteritems():
-            r.append(quote_str(k) + ": " + v.to_str())
+        for leaf in self.kv.leaves():
+            r.append(quote_str(leaf.key) + ": " + leaf.value.to_str())
 
         return "#{" + ", ".join(r) + "}"
 
 
 class Pair(Type):
+    _immutable_fields_ = ["a", "b"]
+
     def __init__(self, a, b):
         Type.__init__(self, TYPE_PAIR)
         self.a = a
@@ -195,11 +632,17 @@ class Nil(Type):
     def is_nil(self):
         return True
 
+    def is_literal(self):
+        return True
+
 
 NIL = Nil()
+TRUE_INT = new_int(1)
 
 
 class Msg(Type):
+    _immutable_fields_ = ["verb", "obj"]
+
     def __init__(self, verb, obj):
         Type.__init__(self, TYPE_MSG)
         self.verb = verb
@@ -210,60 +653,329 @@ class Msg(Type):
 
 
 class Send(Type):
+    _immutable_fields_ = ["subj", "msg"]
+
     def __init__(self, subj, msg):
         Type.__init__(self, TYPE_SEND)
         self.subj = subj
         self.msg = msg
 
     def to_str(self):
-        return self.subj.to_str() + " " + self.msg.verb + " " + self.msg.obj.to_str()
+        msg = self.msg
+        assert isinstance(msg, Msg)
+        return self.subj.to_str() + " " + msg.verb + " " + msg.obj.to_str()
+
+
+class DispatchInfo(object):
+    _immutable_fields_ = ["version?", "count_sends?"]
+
+    def __init__(self):
+        self.version = 0
+        # bumped by every bind that may change dispatch in any scope, for
+        # the VM's inline checks, unlike version it doesn't flush caches
+        self.changes = 0
+        self.hits = 0
+        self.misses = 0
+        # set once at startup by --stats, the JIT folds the check away
+        self.count_sends = False
+        self.sends = 0
+
+    def invalidate(self):
+        self.version += 1
+        self.changes += 1
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+
+# version is bumped by binds on prototypes shared by several type scopes,
+# which only happens while building the prelude; other binds only bump the
+# types_version of the scope that uses the prototype
+dispatch_info = DispatchInfo()
+
+
+class SendMeter(object):
+    """Fuel and limits of the task the scheduler is running, every send
+    takes one unit of fuel and counts towards the task's limits."""
+
+    _immutable_fields_ = ["enabled?"]
+
+    def __init__(self):
+        # set once when the scheduler starts, the JIT folds the check away
+        self.enabled = False
+        self.fuel = 0
+        self.sends = 0
+        self.send_limit = -1
+        self.deadline = -1.0
+
+    def charge(self):
+        self.fuel -= 1
+        self.sends += 1
+
+        if self.send_limit >= 0 and self.sends > self.send_limit:
+            fail("Send limit exceeded")
+
+        # reading the clock on every send would cost more than the send
+        if self.deadline >= 0.0 and self.sends & 1023 == 0:
+            if time.time() > self.deadline:
+                fail("Time limit exceeded")
+
+
+meter = SendMeter()
+
+
+class DispatchCache(object):
+    _immutable_fields_ = ["scope"]
+
+    def __init__(self, scope):
+        # any frame sharing this cache resolves types like scope does
+        self.scope = scope
+        # verb -> handler dicts, indexed by sym_id
+        self.handlers = []
+        self.version = scope.types_version
+        self.global_version = dispatch_info.version
+
+    def lookup(self, sym, verb):
+        # both are quasi-immutable, a trace only depends on its scope's
+        version = self.scope.types_version
+        global_version = dispatch_info.version
+
+        if version != self.version or global_version != self.global_version:
+            self.handlers = []
+            self.version = version
+            self.global_version = global_version
+
+        handler = self.cached(version, global_version, sym, verb)
+
+        if handler is not None:
+            dispatch_info.hits += 1
+            return handler
+
+        dispatch_info.misses += 1
+        proto = self.scope.find_type(sym)
+
+        if proto is None:
+            return None
+
+        handler = proto.find(verb)
+
+        if handler is not None:
+            self.fill(sym, verb, handler)
+
+        return handler
+
+    @elidable
+    def cached(self, version, global_version, sym, verb):
+        # only reads, so the JIT can fold it, lookup does the rest, the
+        # versions make the result depend on what the handlers are for
+        i = sym.sym_id
+
+        if i >= len(self.handlers):
+            return None
+
+        verbs = self.handlers[i]
+
+        if verbs is None:
+            return None
+
+        return verbs.get(verb, None)
+
+    def fill(self, sym, verb, handler):
+        i = sym.sym_id
+
+        while len(self.handlers) <= i:
+            self.handlers.append(None)
+
+        verbs = self.handlers[i]
+
+        if verbs is None:
+            verbs = {}
+            self.handlers[i] = verbs
+
+        verbs[verb] = handler
+
+
+class FrameMap(object):
+    """Shape of a frame's bindings: maps each bound name to a slot index.
+
+    Maps are immutable and shared, frames that bind the same names in the
+    same order end up with the same map, like PyPy's maps for objects.
+    """
+
+    _immutable_fields_ = ["indexes", "length"]
+
+    def __init__(self, indexes, length):
+        self.indexes = indexes
+        self.length = length
+        self.transitions = {}
+
+    @elidable
+    def find_index(self, name):
+        return self.indexes.get(name, -1)
+
+    @elidable
+    def with_name(self, name):
+        m = self.transitions.get(name)
+
+        if m is None:
+            indexes = self.indexes.copy()
+            indexes[name] = self.length
+            m = FrameMap(indexes, self.length + 1)
+            self.transitions[name] = m
+
+        return m
+
+
+EMPTY_MAP = FrameMap({}, 0)
+
+# the type table of frames with no types bound above them
+NO_TYPES = []
 
 
 class Frame(Type):
+    _immutable_fields_ = ["up", "left", "types_version?"]
+
     def __init__(self, left=None, up=None):
         Type.__init__(self, TYPE_FRAME)
         self.up_limit = False
         self.up = up
         self.left_limit = False
         self.left = left
-        self.binds = {}
-        self.type_binds = {}
+        self.map = EMPTY_MAP
+        self.values = []
+        # prototypes indexed by sym_id, None to use the parent's table
+        self.types = None
+        # bumped when a bind changes what this frame's types resolve to
+        self.types_version = 0
+        # the type scope whose prototypes look handlers up through this
+        # frame, shared if there are several
+        self.proto_scope = None
+        self.proto_shared = False
+        self.dispatch_cache = None
+        self.eval_msg = None
 
     def bind(self, name, value):
-        self.binds[name] = value
+        i = promote(self.map).find_index(name)
+
+        if i == -1:
+            self.map = self.map.with_name(name)
+            self.values.append(value)
+        else:
+            self.values[i] = value
+
+        if self.proto_shared:
+            dispatch_info.invalidate()
+        elif self.proto_scope is not None:
+            self.proto_scope.types_changed()
+
         return self
 
+    @unroll_safe
     def find(self, name):
-        v = self.binds.get(name)
+        f = self
 
-        if v is None:
-            if self.up_limit or self.up is None:
-                if self.left_limit or self.left is None:
-                    return v
-                else:
-                    return self.left.find(name)
-            else:
-                return self.up.find(name)
-        else:
-            return v
+        while f is not None:
+            i = promote(f.map).find_index(name)
+
+            if i != -1:
+                return f.values[i]
+
+            f = f.lookup_parent()
+
+        return None
 
     def bind_type(self, sym, value):
-        self.type_binds[sym.sym_name] = value
+        """Binds the prototype of sym here, the first bind copies the table
+        this frame resolved types with, so frames below see the parent's
+        types as they were then. Types are bound while setting up a frame,
+        before anything runs in it."""
+        if self.types is None:
+            self.types = self.type_table()[:]
+            # it resolved types with its parent's cache until now
+            self.dispatch_cache = None
+
+        types = self.types
+
+        while len(types) <= sym.sym_id:
+            types.append(None)
+
+        types[sym.sym_id] = value
+        value.mark_proto(self)
+        self.types_changed()
+        return self
+
+    def init_types(self, types):
+        """Gives a new frame its types table at once. Nothing has looked
+        types up through it yet, so unlike bind_type there's no cache to
+        invalidate."""
+        assert self.types is None and self.dispatch_cache is None
+        self.types = types
+
+        for proto in types:
+            if proto is not None:
+                proto.mark_proto(self)
+
         return self
 
+    def types_changed(self):
+        self.types_version += 1
+        dispatch_info.changes += 1
+
+    @unroll_safe
+    def type_table(self):
+        f = self
+
+        while f is not None:
+            if f.types is not None:
+                return f.types
+
+            f = f.lookup_parent()
+
+        return NO_TYPES
+
     def find_type(self, sym):
-        v = self.type_binds.get(sym.sym_name)
+        types = self.type_table()
+        i = sym.sym_id
 
-        if v is None:
-            if self.up_limit or self.up is None:
-                if self.left_limit or self.left is None:
-                    return v
-                else:
-                    return self.left.find_type(sym)
+        if i < len(types):
+            return types[i]
+
+        return None
+
+    def lookup_parent(self):
+        if self.up_limit or self.up is None:
+            if self.left_limit or self.left is None:
+                return None
             else:
-                return self.up.find_type(sym)
+                return self.left
         else:
-            return v
+            return self.up
+
+    def mark_proto(self, scope):
+        # binds on a prototype or on any frame its handler lookup walks
+        # through must invalidate the dispatch cache of scope
+        f = self
+
+        while f is not None:
+            if f.proto_scope is None:
+                f.proto_scope = scope
+            elif f.proto_scope is not scope:
+                f.proto_shared = True
+
+            f = f.lookup_parent()
+
+    def get_dispatch_cache(self):
+        if self.dispatch_cache is None:
+            parent = self.lookup_parent()
+
+            if parent is None or self.types is not None:
+                self.dispatch_cache = DispatchCache(self)
+            else:
+                # same type resolution as the parent, share its cache
+                self.dispatch_cache = parent.get_dispatch_cache()
+
+        return self.dispatch_cache
 
     def down(self):
         return Frame(self.left, self)
@@ -273,43 +985,121 @@ class Frame(Type):
 
     def set_up_limit(self):
         self.up_limit = True
+        self.dispatch_cache = None
         return self
 
     def set_left_limit(self):
         self.left_limit = True
+        self.dispatch_cache = None
         return self
 
+    def get_eval_msg(self):
+        if self.eval_msg is None:
+            self.eval_msg = Msg("eval", self)
+
+        return self.eval_msg
+
     def eval(self, v):
-        return self.send(v, Msg("eval", self))
+        # literals evaluate to themselves unless their eval was rebound
+        if v.is_literal():
+            handler = self.lookup_handler(v.type, "eval")
 
-    def get_send_handler(self, s, m):
-        proto = self.find_type(s.type)
+            if handler is not None and handler.is_self_eval():
+                return v
 
-        if proto:
-            # print("proto found for", s.type.sym_name, m.verb, s.to_str())
-            return proto.find(m.verb)
-        else:
+        return self.dispatch(v, "eval", v, self.get_eval_msg())
+
+    def lookup_handler(self, sym, verb):
+        cache = promote(self.get_dispatch_cache())
+        return cache.lookup(promote(sym), verb)
+
+    def get_send_handler(self, s, verb):
+        handler = self.lookup_handler(s.type, verb)
+
+        if handler is None and self.find_type(s.type) is None:
             print(
                 "proto not found for type",
                 s.type.sym_name,
                 "verb",
-                m.verb,
+                verb,
                 "s",
                 s.to_str(),
             )
-            return None
+
+        return handler
 
     def send(self, s, m):
-        jitdriver.jit_merge_point(s=s, m=m, e=self)
-        handler = self.get_send_handler(s, m)
+        return self.dispatch(None, m.verb, s, m)
+
+    def child_handler(self, s, verb):
+        """Returns the handler a send from self.down() would dispatch to."""
+        if self.left is None:
+            return None
+
+        # down() frames are up limited, they resolve types from our left
+        return self.left.lookup_handler(s.type, verb)
+
+    def handle_frameless(self, handler, s, m, verb):
+        """Runs a handler that doesn't need the frame of its send without
+        making one, it and that are s and m.obj."""
+        if dispatch_info.count_sends:
+            dispatch_info.sends += 1
+
+        if meter.enabled:
+            meter.charge()
+
+        if profiler.enabled:
+            return self.profile_handle(handler, s, m, verb)
+
+        return handler.handle(s, m, self)
+
+    def dispatch(self, node, verb, s, m):
+        jitdriver.jit_merge_point(node=node, verb=verb, s=s, m=m, e=self)
+
+        if dispatch_info.count_sends:
+            dispatch_info.sends += 1
+
+        if meter.enabled:
+            meter.charge()
+
+        handler = self.get_send_handler(s, verb)
 
         if handler is not None:
-            r = handler.handle(s, m, self)
-            jitdriver.can_enter_jit(s=s, m=m, e=self)
-            return r
+            if profiler.enabled:
+                return self.profile_handle(handler, s, m, verb)
+
+            return handler.handle(s, m, self)
         else:
-            print("handler not found for", s.type.sym_name, s.to_str(), m.to_str())
-            fail("HandlerNotFound: " + s.to_str())
+            handler_not_found(s, m)
+
+    def profile_handle(self, handler, s, m, verb):
+        profiler.enter(s.type.sym_name, verb)
+
+        try:
+            return handler.handle(s, m, self)
+        finally:
+            profiler.leave()
+
+
+class Engine(object):
+    """Runs programs and AST handler bodies, by walking the tree."""
+
+    def eval_program(self, node, e):
+        return e.eval(node)
+
+    def eval_body(self, node, e):
+        return e.eval(node)
+
+
+class EngineRef(object):
+    _immutable_fields_ = ["engine?"]
+
+    def __init__(self):
+        self.engine = Engine()
+
+
+# the engine in use, fatt swaps in fatt_cek's or the bytecode VM
+engine_ref = EngineRef()
 
 
 class Error(Exception):
@@ -334,6 +1124,11 @@ def type_expected(expected, a, b):
     )
 
 
+def handler_not_found(s, m):
+    print("handler not found for", s.type.sym_name, s.to_str(), m.to_str())
+    fail("HandlerNotFound: " + s.to_str())
+
+
 def val_type_expected(expected, v):
     fail("Expected '" + expected.sym_name + "' got '" + v.type.sym_name + "'")
 
@@ -361,22 +1156,79 @@ class BinOpHandler(Type):
         self.type_expected = type_expected
 
     def handle(self, s, m, e):
-        if self.type_pred(s) and self.type_pred(m.obj):
+        if self.accepts(s, m.obj):
             return self.apply_op(s, m.obj)
         else:
             self.type_expected(s, m.obj)
 
+    def accepts(self, a, b):
+        return self.type_pred(a) and self.type_pred(b)
+
     def apply_op(self, a, b):
         return NIL
 
+    def needs_frame(self):
+        return False
+
+
+INT_ADD = 0
+INT_SUB = 1
+INT_MUL = 2
+
 
 class IntBinOpHandler(BinOpHandler):
+    """op is INT_ADD, INT_SUB or INT_MUL, done on machine ints while the
+    result fits and on rbigints once it doesn't."""
+
+    _immutable_fields_ = ["op"]
+
     def __init__(self, op):
         BinOpHandler.__init__(self, lambda x: x.is_int(), int_expected)
-        self.iop = op
+        self.op = op
+
+    def handle(self, s, m, e):
+        b = m.obj
+
+        if isinstance(s, Int) and isinstance(b, Int):
+            return self.apply_ints(s.ival, b.ival)
+        elif s.is_int() and b.is_int():
+            return self.apply_big(to_rbigint(s), to_rbigint(b))
+        else:
+            int_expected(s, b)
 
     def apply_op(self, a, b):
-        return Int(self.iop(a.ival, b.ival))
+        if isinstance(a, Int) and isinstance(b, Int):
+            return self.apply_ints(a.ival, b.ival)
+
+        return self.apply_big(to_rbigint(a), to_rbigint(b))
+
+    def apply_ints(self, a, b):
+        op = self.op
+
+        # the JIT needs each ovfcheck in the block that catches its overflow
+        try:
+            if op == INT_ADD:
+                r = ovfcheck(a + b)
+            elif op == INT_SUB:
+                r = ovfcheck(a - b)
+            else:
+                r = ovfcheck(a * b)
+        except OverflowError:
+            return self.apply_big(rbigint.fromint(a), rbigint.fromint(b))
+
+        return new_int(r)
+
+    def apply_big(self, a, b):
+        op = self.op
+
+        if op == INT_ADD:
+            r = a.add(b)
+        elif op == INT_SUB:
+            r = a.sub(b)
+        else:
+            r = a.mul(b)
+
+        return new_big_int(r)
 
 
 class FloatBinOpHandler(BinOpHandler):
@@ -384,21 +1236,33 @@ class FloatBinOpHandler(BinOpHandler):
         BinOpHandler.__init__(self, lambda x: x.is_float(), float_expected)
         self.fop = op
 
+    def handle(self, s, m, e):
+        b = m.obj
+
+        if isinstance(s, Float) and isinstance(b, Float):
+            return Float(self.fop(s.fval, b.fval))
+        else:
+            float_expected(s, b)
+
     def apply_op(self, a, b):
+        assert isinstance(a, Float) and isinstance(b, Float)
         return Float(self.fop(a.fval, b.fval))
 
 
 class StrBinOpHandler(BinOpHandler):
+    """sop takes and returns Strs, so it can build ropes."""
+
     def __init__(self, op):
         BinOpHandler.__init__(self, lambda x: x.is_str(), str_expected)
         self.sop = op
 
     def apply_op(self, a, b):
-        return Str(self.sop(a.sval, b.sval))
+        assert isinstance(a, Str) and isinstance(b, Str)
+        return self.sop(a, b)
 
 
-def int_binop(fn):
-    return IntBinOpHandler(fn)
+def int_binop(op):
+    return IntBinOpHandler(op)
 
 
 def float_binop(fn):
@@ -416,8 +1280,11 @@ class BaseCompOpHandler(Type):
         self.right_type_pred = right_type_pred
         self.type_expected = type_expected
 
+    def needs_frame(self):
+        return False
+
     def handle(self, s, m, e):
-        if self.left_type_pred(s) and self.right_type_pred(m.obj):
+        if self.accepts(s, m.obj):
             if self.compare(s, m.obj):
                 return self.get_return_for_true(s, m.obj)
             else:
@@ -425,6 +1292,9 @@ class BaseCompOpHandler(Type):
         else:
             self.type_expected(s, m.obj)
 
+    def accepts(self, a, b):
+        return self.left_type_pred(a) and self.right_type_pred(b)
+
     def compare(self, a, b):
         return False
 
@@ -440,12 +1310,32 @@ class CompOpHandler(BaseCompOpHandler):
 
 
 class IntCompOpHandler(CompOpHandler):
-    def __init__(self, comp_op):
+    def __init__(self, comp_op, big_comp_op):
         CompOpHandler.__init__(self, lambda x: x.is_int(), int_expected)
         self.icomp = comp_op
+        self.bcomp = big_comp_op
+
+    def handle(self, s, m, e):
+        b = m.obj
+
+        if isinstance(s, Int) and isinstance(b, Int):
+            if self.icomp(s.ival, b.ival):
+                return s
+            else:
+                return NIL
+        elif s.is_int() and b.is_int():
+            if self.bcomp(to_rbigint(s), to_rbigint(b)):
+                return s
+            else:
+                return NIL
+        else:
+            int_expected(s, b)
 
     def compare(self, a, b):
-        return self.icomp(a.ival, b.ival)
+        if isinstance(a, Int) and isinstance(b, Int):
+            return self.icomp(a.ival, b.ival)
+
+        return self.bcomp(to_rbigint(a), to_rbigint(b))
 
 
 class FloatCompOpHandler(CompOpHandler):
@@ -453,7 +1343,19 @@ class FloatCompOpHandler(CompOpHandler):
         CompOpHandler.__init__(self, lambda x: x.is_float(), float_expected)
         self.fcomp = comp_op
 
+    def handle(self, s, m, e):
+        b = m.obj
+
+        if isinstance(s, Float) and isinstance(b, Float):
+            if self.fcomp(s.fval, b.fval):
+                return s
+            else:
+                return NIL
+        else:
+            float_expected(s, b)
+
     def compare(self, a, b):
+        assert isinstance(a, Float) and isinstance(b, Float)
         return self.fcomp(a.fval, b.fval)
 
 
@@ -463,7 +1365,8 @@ class StrCompOpHandler(CompOpHandler):
         self.scomp = comp_op
 
     def compare(self, a, b):
-        return self.scomp(a.sval, b.sval)
+        assert isinstance(a, Str) and isinstance(b, Str)
+        return self.scomp(a.flatten(), b.flatten())
 
 
 class NilCompOpHandler(BaseCompOpHandler):
@@ -477,11 +1380,11 @@ class NilCompOpHandler(BaseCompOpHandler):
         return self.ncomp(a, b)
 
     def get_return_for_true(self, left, right):
-        return Int(1) if right.is_nil() else right
+        return TRUE_INT if right.is_nil() else right
 
 
-def int_compop(fn):
-    return IntCompOpHandler(fn)
+def int_compop(fn, big_fn):
+    return IntCompOpHandler(fn, big_fn)
 
 
 def float_compop(fn):
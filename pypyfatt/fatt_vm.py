@@ -0,0 +1,466 @@
+from __future__ import print_function
+from rpython.rlib.jit import JitDriver, elidable, promote
+from fatt_types import *
+from fatt_prelude import (
+    PRELUDE_TYPES,
+    ROOT_FRAME,
+    name_lookup,
+    nil_or,
+    nil_ternary,
+    true_and,
+    true_ternary,
+)
+
+# opcodes, their arguments follow them inline in Code.ops, "need" is a mask
+# of the types whose eval handler must be the builtin one for the fast path
+
+LOAD_CONST = 0  # need, const: push the value of consts[const]
+LOAD_NAME = 1  # need, const: push the value bound to the Name consts[const]
+BUILD_PAIR = 2  # pop b and a, push a:b
+BUILD_ARRAY = 3  # count: pop count items, push an Array of them
+BUILD_MAP = 4  # keys: pop one value per key in key_lists[keys], push a Map
+BUILD_MSG = 5  # const: pop obj, push a Msg with the verb of consts[const]
+SEND = 6  # const: pop obj and subj, send the Msg of the Send consts[const]
+SEND_VALUE = 7  # const: pop msg and subj, send msg for the Send consts[const]
+EVAL = 8  # const: push consts[const] evaluated by the tree-walker
+POP = 9
+GUARD = 10  # need, const, target: if need doesn't hold eval consts[const]
+# with the tree-walker and jump to target, skipping its compiled code
+RETURN = 11
+
+OP_NAMES = [
+    "LOAD_CONST",
+    "LOAD_NAME",
+    "BUILD_PAIR",
+    "BUILD_ARRAY",
+    "BUILD_MAP",
+    "BUILD_MSG",
+    "SEND",
+    "SEND_VALUE",
+    "EVAL",
+    "POP",
+    "GUARD",
+    "RETURN",
+]
+
+# the eval handler each prelude type starts with, same order as PRELUDE_TYPES
+BUILTIN_EVAL = [ROOT_FRAME.find_type(sym).find("eval") for sym in PRELUDE_TYPES]
+
+
+def type_bit(sym):
+    for i in range(len(PRELUDE_TYPES)):
+        if PRELUDE_TYPES[i] is sym:
+            return 1 << i
+
+    assert False, "not a prelude type"
+
+
+def builtin_eval_mask(e):
+    mask = 0
+
+    for i in range(len(PRELUDE_TYPES)):
+        if e.lookup_handler(PRELUDE_TYPES[i], "eval") is BUILTIN_EVAL[i]:
+            mask |= 1 << i
+
+    return mask
+
+
+class Code(object):
+    _immutable_fields_ = [
+        "ops[*]",
+        "consts[*]",
+        "values[*]",
+        "key_lists[*]",
+        "stack_size",
+    ]
+
+    def __init__(self, ops, consts, values, key_lists, stack_size):
+        self.ops = ops
+        self.consts = consts
+        self.values = values
+        self.key_lists = key_lists
+        self.stack_size = stack_size
+
+
+class Compiler(object):
+    def __init__(self):
+        self.ops = []
+        self.consts = []
+        self.values = []
+        self.key_lists = []
+        self.depth = 0
+        self.max_depth = 0
+
+    def add_const(self, node, value):
+        self.consts.append(node)
+        self.values.append(value)
+        return len(self.consts) - 1
+
+    def push(self, n):
+        self.depth += n
+
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+
+    def emit_guard(self, node, need):
+        self.ops.append(GUARD)
+        self.ops.append(need)
+        self.ops.append(self.add_const(node, node))
+        self.ops.append(-1)
+        return len(self.ops) - 1
+
+    def patch(self, target_at):
+        self.ops[target_at] = len(self.ops)
+
+    def compile_node(self, node):
+        if node.is_literal():
+            self.ops.append(LOAD_CONST)
+            self.ops.append(type_bit(node.type))
+            self.ops.append(self.add_const(node, node))
+            self.push(1)
+        elif isinstance(node, Later):
+            self.ops.append(LOAD_CONST)
+            self.ops.append(type_bit(TYPE_LATER))
+            self.ops.append(self.add_const(node, node.lval))
+            self.push(1)
+        elif isinstance(node, Name):
+            self.ops.append(LOAD_NAME)
+            self.ops.append(type_bit(TYPE_NAME))
+            self.ops.append(self.add_const(node, node))
+            self.push(1)
+        elif isinstance(node, Block):
+            target_at = self.emit_guard(node, type_bit(TYPE_BLOCK))
+
+            if len(node.items) == 0:
+                self.ops.append(LOAD_CONST)
+                self.ops.append(0)
+                self.ops.append(self.add_const(NIL, NIL))
+                self.push(1)
+
+            for i in range(len(node.items)):
+                if i > 0:
+                    self.ops.append(POP)
+                    self.push(-1)
+
+                self.compile_node(node.items[i])
+
+            self.patch(target_at)
+        elif isinstance(node, Pair):
+            target_at = self.emit_guard(node, type_bit(TYPE_PAIR))
+            self.compile_node(node.a)
+            self.compile_node(node.b)
+            self.ops.append(BUILD_PAIR)
+            self.push(-1)
+            self.patch(target_at)
+        elif isinstance(node, Array):
+            target_at = self.emit_guard(node, type_bit(TYPE_ARRAY))
+
+            items = node.items()
+
+            for item in items:
+                self.compile_node(item)
+
+            self.ops.append(BUILD_ARRAY)
+            self.ops.append(len(items))
+            self.push(1 - len(items))
+            self.patch(target_at)
+        elif isinstance(node, Map):
+            target_at = self.emit_guard(node, type_bit(TYPE_MAP))
+            keys = []
+
+            for leaf in node.kv.leaves():
+                keys.append(leaf.key)
+                self.compile_node(leaf.value)
+
+            self.key_lists.append(keys)
+            self.ops.append(BUILD_MAP)
+            self.ops.append(len(self.key_lists) - 1)
+            self.push(1 - len(keys))
+            self.patch(target_at)
+        elif isinstance(node, Msg):
+            target_at = self.emit_guard(node, type_bit(TYPE_MSG))
+            self.compile_node(node.obj)
+            self.ops.append(BUILD_MSG)
+            self.ops.append(self.add_const(node, node))
+            self.patch(target_at)
+        elif isinstance(node, Send):
+            msg = node.msg
+
+            if isinstance(msg, Msg):
+                # the Msg is built by SEND, so its eval must be builtin too
+                need = type_bit(TYPE_SEND) | type_bit(TYPE_MSG)
+                target_at = self.emit_guard(node, need)
+                self.compile_node(node.subj)
+                self.compile_node(msg.obj)
+                self.ops.append(SEND)
+            else:
+                target_at = self.emit_guard(node, type_bit(TYPE_SEND))
+                self.compile_node(node.subj)
+                self.compile_node(msg)
+                self.ops.append(SEND_VALUE)
+
+            self.ops.append(self.add_const(node, node))
+            self.push(-1)
+            self.patch(target_at)
+        else:
+            self.ops.append(EVAL)
+            self.ops.append(self.add_const(node, node))
+            self.push(1)
+
+    def finish(self):
+        self.ops.append(RETURN)
+
+        return Code(
+            [op for op in self.ops],
+            [c for c in self.consts],
+            [v for v in self.values],
+            [keys for keys in self.key_lists],
+            self.max_depth,
+        )
+
+
+def compile_code(node):
+    c = Compiler()
+    c.compile_node(node)
+    return c.finish()
+
+
+class Call(object):
+    """The caller left waiting while run evaluates the body of its send."""
+
+    def __init__(self, code, pc, sp, stack, e, mask, version, up):
+        self.code = code
+        self.pc = pc
+        self.sp = sp
+        self.stack = stack
+        self.e = e
+        self.mask = mask
+        self.version = version
+        self.up = up
+
+
+def handler_body(handler, m):
+    """Returns the AST a send to handler evaluates in its frame, like the
+    branches of ?, and, or, or None if the handler has to be called."""
+    if handler.type is not TYPE_HANDLER:
+        # an AST bound with replies
+        return handler
+    elif isinstance(handler, Handler):
+        fn = handler.fn
+        obj = m.obj
+
+        if fn is true_ternary and isinstance(obj, Pair):
+            return obj.a
+        elif fn is nil_ternary and isinstance(obj, Pair):
+            return obj.b
+        elif fn is true_and or fn is nil_or:
+            return obj
+
+    return None
+
+
+def get_printable_location(pc, code):
+    return OP_NAMES[code.ops[pc]] + " @" + str(pc)
+
+
+vmdriver = JitDriver(
+    greens=["pc", "code"],
+    reds=["sp", "mask", "version", "stack", "e", "calls"],
+    get_printable_location=get_printable_location,
+    is_recursive=True,
+)
+
+
+def run(code, e):
+    stack = [None] * code.stack_size
+    sp = 0
+    pc = 0
+    # mask of builtin eval handlers as seen from e, recomputed whenever a
+    # bind may have changed dispatch
+    mask = 0
+    version = -1
+    # the callers of the body being run, sends to AST handlers don't recurse
+    # on the host stack
+    calls = None
+
+    while True:
+        vmdriver.jit_merge_point(
+            pc=pc,
+            code=code,
+            sp=sp,
+            mask=mask,
+            version=version,
+            stack=stack,
+            e=e,
+            calls=calls,
+        )
+        op = code.ops[pc]
+
+        if op == LOAD_CONST or op == LOAD_NAME or op == GUARD:
+            if version != dispatch_info.changes:
+                mask = builtin_eval_mask(e)
+                version = dispatch_info.changes
+
+            need = code.ops[pc + 1]
+            node = code.consts[code.ops[pc + 2]]
+
+            if (mask & need) != need:
+                stack[sp] = e.eval(node)
+                sp += 1
+                pc = code.ops[pc + 3] if op == GUARD else pc + 3
+            elif op == LOAD_CONST:
+                stack[sp] = code.values[code.ops[pc + 2]]
+                sp += 1
+                pc += 3
+            elif op == LOAD_NAME:
+                stack[sp] = name_lookup(node, None, e)
+                sp += 1
+                pc += 3
+            else:
+                pc += 4
+        elif op == SEND or op == SEND_VALUE:
+            node = code.consts[code.ops[pc + 1]]
+            assert isinstance(node, Send)
+            subj = stack[sp - 2]
+            msg = stack[sp - 1]
+
+            if op == SEND:
+                msg_node = node.msg
+                assert isinstance(msg_node, Msg)
+                msg = Msg(msg_node.verb, msg)
+
+            sp -= 2
+
+            if not isinstance(msg, Msg):
+                val_type_expected(TYPE_MSG, msg)
+
+            verb = msg.verb
+            handler = e.child_handler(subj, verb)
+
+            if handler is not None and not handler.needs_frame():
+                stack[sp] = e.handle_frameless(handler, subj, msg, verb)
+                sp += 1
+                pc += 2
+                continue
+
+            callee = e.down().set_up_limit().bind("it", subj).bind("that", msg.obj)
+
+            if dispatch_info.count_sends:
+                dispatch_info.sends += 1
+
+            if meter.enabled:
+                meter.charge()
+
+            handler = callee.get_send_handler(subj, verb)
+
+            if handler is None:
+                handler_not_found(subj, msg)
+
+            body = None if profiler.enabled else handler_body(handler, msg)
+
+            if body is None:
+                if profiler.enabled:
+                    stack[sp] = callee.profile_handle(handler, subj, msg, verb)
+                else:
+                    stack[sp] = handler.handle(subj, msg, callee)
+
+                sp += 1
+                pc += 2
+            else:
+                calls = Call(code, pc + 2, sp, stack, e, mask, version, calls)
+                code = VM_ENGINE.get_code(body)
+                stack = [None] * code.stack_size
+                sp = 0
+                pc = 0
+                e = callee
+                version = -1
+        elif op == BUILD_PAIR:
+            sp -= 1
+            stack[sp - 1] = Pair(stack[sp - 1], stack[sp])
+            pc += 1
+        elif op == BUILD_ARRAY:
+            count = code.ops[pc + 1]
+            sp -= count
+            end = sp + count
+            assert sp >= 0 and end >= 0
+            stack[sp] = new_array(stack[sp:end])
+            sp += 1
+            pc += 2
+        elif op == BUILD_MAP:
+            keys = code.key_lists[code.ops[pc + 1]]
+            sp -= len(keys)
+            kv = EMPTY_PMAP
+
+            for i in range(len(keys)):
+                kv = kv.assoc(keys[i], stack[sp + i])
+
+            stack[sp] = Map(kv)
+            sp += 1
+            pc += 2
+        elif op == BUILD_MSG:
+            node = code.consts[code.ops[pc + 1]]
+            assert isinstance(node, Msg)
+            stack[sp - 1] = Msg(node.verb, stack[sp - 1])
+            pc += 2
+        elif op == EVAL:
+            stack[sp] = e.eval(code.consts[code.ops[pc + 1]])
+            sp += 1
+            pc += 2
+        elif op == POP:
+            sp -= 1
+            pc += 1
+        elif op == RETURN:
+            value = stack[sp - 1]
+
+            if calls is None:
+                return value
+
+            code = calls.code
+            pc = calls.pc
+            sp = calls.sp
+            stack = calls.stack
+            e = calls.e
+            mask = calls.mask
+            version = calls.version
+            calls = calls.up
+            stack[sp] = value
+            sp += 1
+        else:
+            fail("bad opcode " + str(op))
+
+
+class VMEngine(Engine):
+    """Compiles programs and AST handler bodies to bytecode and runs them.
+
+    Nodes the compiler has no instruction for, and any node whose eval
+    handler was rebound at run time, are evaluated by the tree-walker, so
+    replies on eval behaves the same in both engines.
+    """
+
+    def __init__(self):
+        self.codes = {}
+
+    def eval_program(self, node, e):
+        # bodies compiled for an earlier program can't be reached anymore
+        self.codes = {}
+        return run(compile_code(node), e)
+
+    def eval_body(self, node, e):
+        return run(self.get_code(promote(node)), e)
+
+    @elidable
+    def get_code(self, node):
+        code = self.codes.get(node, None)
+
+        if code is None:
+            code = compile_code(node)
+            self.codes[node] = code
+
+        return code
+
+
+VM_ENGINE = VMEngine()
+
+
+def use_vm():
+    engine_ref.engine = VM_ENGINE